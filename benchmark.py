@@ -0,0 +1,497 @@
+"""
+Offline benchmark for the bot.  Runs the real command handlers (on_message, handle_play_command,
+handle_song_end, the idle timer) for N simulated guilds, against fake Discord voice clients and a stub
+yt_dlp that "downloads" generated audio files from disk, so no Discord connection or YouTube access
+is needed.  ffmpeg is still used for real, same as when the bot is running.
+
+Reports commands per second, event loop lag, time to first audio, gaps between songs, stalls in the
+audio, idle disconnect accuracy and memory use.
+
+Usage:
+    python benchmark.py --guilds 20 --songs 4 --song-seconds 3
+    python benchmark.py --guilds 50 --json bench.json   # also save the results, to compare runs
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import psutil
+
+import settings
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the bot offline against simulated guilds.")
+    parser.add_argument("--guilds", type=int, default=10, help="number of simulated guilds")
+    parser.add_argument("--songs", type=int, default=3, help="songs each guild plays")
+    parser.add_argument("--song-seconds", type=float, default=3, help="length of each generated song")
+    parser.add_argument("--library", type=int, default=8, help="number of distinct audio files to generate")
+    parser.add_argument("--commands", type=int, default=20, help="extra commands per guild for the throughput test")
+    parser.add_argument("--search-delay", type=float, default=0.05, help="simulated YouTube search time, in seconds")
+    parser.add_argument("--download-delay", type=float, default=0.2, help="simulated download time, in seconds")
+    parser.add_argument("--idle-timeout", type=float, default=1, help="idle timeout to use, in seconds")
+    parser.add_argument("--timeout", type=float, default=300, help="give up waiting for playback after this long")
+    parser.add_argument("--log-level", default="WARNING", help="the bot's log level during the run")
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args()
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def describe(values, unit=1000, suffix="ms"):
+    """
+    p50 / p95 / max of a list of seconds, for the report.
+    """
+    if not values:
+        return "n/a"
+    return (
+        f"p50 {percentile(values, 0.5) * unit:.1f}{suffix}, p95 {percentile(values, 0.95) * unit:.1f}{suffix}, "
+        f"max {max(values) * unit:.1f}{suffix} ({len(values)} samples)"
+    )
+
+
+########################################
+# Stub yt_dlp                          #
+########################################
+
+class StubYoutubeDL:
+    """
+    Stands in for yt_dlp.YoutubeDL.  Every search term or URL maps to a stable fake video ID, and
+    "downloading" a video copies one of the generated library files to the requested path.
+    """
+    library = []
+    search_delay = 0
+    download_delay = 0
+
+    def __init__(self, opts=None):
+        self.opts = opts or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @staticmethod
+    def video_id(query):
+        return hashlib.md5(query.encode()).hexdigest()[:11]
+
+    def video_info(self, video_id):
+        return {
+            "id": video_id,
+            "title": f"Benchmark song {video_id}",
+            "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+            "duration": None,
+            "formats": [
+                {"format_id": "140", "ext": "m4a", "acodec": "mp4a.40.2", "vcodec": "none", "abr": 128,
+                 "url": self.library_file(video_id)},
+                {"format_id": "251", "ext": "webm", "acodec": "opus", "vcodec": "none", "abr": 96,
+                 "url": self.library_file(video_id)},
+            ],
+        }
+
+    def extract_info(self, query, download=False):
+        time.sleep(self.search_delay)
+        if "watch?v=" in query:
+            return self.video_info(query.split("watch?v=")[1].split("&")[0])
+        return {"entries": [self.video_info(self.video_id(query))]}
+
+    def library_file(self, video_id):
+        # Stands in for the direct stream URL as well as the downloaded file
+        return self.library[int(video_id, 16) % len(self.library)]
+
+    def process_ie_result(self, info, download=True):
+        return self.download([info["webpage_url"]])
+
+    def download(self, urls):
+        for url in urls:
+            video_id = url.split("watch?v=")[1]
+            source = self.library_file(video_id)
+            time.sleep(self.download_delay)
+            for hook in self.opts.get("progress_hooks", []):
+                hook({"status": "finished", "filename": self.opts["outtmpl"]})
+            shutil.copyfile(source, self.opts["outtmpl"])
+        return 0
+
+
+def generate_library(directory, count, seconds):
+    """
+    Generates `count` short Opus tones to serve as songs.
+    """
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"tone{i}.webm")
+        subprocess.run(
+            [
+                "ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi",
+                "-i", f"sine=frequency={220 + 55 * i}:duration={seconds}",
+                "-ac", "2", "-ar", "48000", "-c:a", "libopus", "-b:a", "96k", path
+            ],
+            check=True
+        )
+        paths.append(path)
+    return paths
+
+
+########################################
+# Fake Discord objects                 #
+########################################
+
+class FakePermissions:
+    connect = True
+    speak = True
+    value = 0
+
+
+class FakeMember:
+    def __init__(self, member_id, name, bot=False, voice_channel=None):
+        self.id = member_id
+        self.name = name
+        self.bot = bot
+        self.voice = FakeVoiceState(voice_channel) if voice_channel is not None else None
+
+
+class FakeVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class FakeTextChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.guild = guild
+        self.sent = []
+
+    async def send(self, content):
+        self.sent.append((time.perf_counter(), content))
+
+
+class FakeVoiceChannel:
+    def __init__(self, channel_id, guild, bench):
+        self.id = channel_id
+        self.guild = guild
+        self.name = f"voice-{channel_id}"
+        self.bitrate = 64000
+        self.user_limit = 0
+        self.members = []
+        self.bench = bench
+
+    def permissions_for(self, member):
+        return FakePermissions()
+
+    async def connect(self, timeout=None, reconnect=True):
+        await asyncio.sleep(0.01)  # a little round trip, like the real handshake
+        voice_client = FakeVoiceClient(self, self.bench)
+        self.bench.bot._connection._add_voice_client(self.guild.id, voice_client)
+        return voice_client
+
+
+class FakeGuild:
+    def __init__(self, guild_id, bench):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.member_count = 2
+        self.me = FakeMember(bench.bot.user.id, "bot", bot=True)
+        self.voice_channel = FakeVoiceChannel(guild_id * 10 + 1, self, bench)
+        self.text_channel = FakeTextChannel(guild_id * 10 + 2, self)
+        self.text_channels = [self.text_channel]
+        self.bench = bench
+
+    @property
+    def voice_client(self):
+        return self.bench.bot._connection._get_voice_client(self.id)
+
+
+class FakeMessage:
+    def __init__(self, content, author, guild):
+        self.content = content
+        self.author = author
+        self.guild = guild
+        self.channel = guild.text_channel
+
+
+class FakeVoiceClient:
+    """
+    Behaves like discord.VoiceClient as far as the bot is concerned.  play() starts a thread that reads
+    a 20ms frame from the source every 20ms, the way discord.py's AudioPlayer does, and records when
+    each frame arrived.
+    """
+    FRAME_SECONDS = 0.02
+
+    def __init__(self, channel, bench):
+        self.channel = channel
+        self.guild = channel.guild
+        self.latency = 0.0
+        self.bench = bench
+        self.connected = True
+        self.disconnected_at = None
+        self.frame_times = []
+        self.stalls = []
+        self._player = None
+        self._stop = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_alive() and self._resumed.is_set()
+
+    def is_paused(self):
+        return self._player is not None and self._player.is_alive() and not self._resumed.is_set()
+
+    def play(self, source, after=None):
+        if self.is_playing() or self.is_paused():
+            raise RuntimeError("Already playing audio.")
+        self._stop = threading.Event()
+        self._resumed.set()
+        self._player = threading.Thread(target=self._run, args=(source, after, self._stop), daemon=True)
+        self._player.start()
+
+    def _run(self, source, after, stop):
+        error = None
+        next_frame = time.perf_counter()
+        try:
+            while not stop.is_set():
+                if not self._resumed.is_set():
+                    self._resumed.wait()
+                    next_frame = time.perf_counter()
+                    continue
+                data = source.read()
+                if not data:
+                    break
+                now = time.perf_counter()
+                if self.frame_times and now - self.frame_times[-1] > 2 * self.FRAME_SECONDS:
+                    self.stalls.append(now - self.frame_times[-1] - self.FRAME_SECONDS)
+                self.frame_times.append(now)
+                next_frame += self.FRAME_SECONDS
+                time.sleep(max(0, next_frame - time.perf_counter()))
+        except Exception as e:
+            error = e
+        finally:
+            source.cleanup()
+            if after is not None:
+                after(error)
+
+    def stop(self):
+        # Like discord.py, the old player thread winds down (and calls `after`) in the background
+        self._stop.set()
+        self._resumed.set()
+        self._player = None
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    async def disconnect(self, force=False):
+        self.stop()
+        self.connected = False
+        self.disconnected_at = time.perf_counter()
+        self.bench.bot._connection._remove_voice_client(self.guild.id)
+
+
+########################################
+# The benchmark                        #
+########################################
+
+class Benchmark:
+    def __init__(self, bot_module, args):
+        self.db = bot_module
+        self.bot = bot_module.bot
+        self.args = args
+        self.stage_samples = {}
+        self.loop_lag = []
+        self.first_audio = {}
+        self.guilds = []
+
+    def setup(self):
+        self.bot._connection.user = FakeMember(1, "pancrythm", bot=True)
+
+        # Keep every raw timing the bot records, not just its histograms
+        observe_stage = self.db.observe_stage
+
+        def record_stage(stage, seconds):
+            self.stage_samples.setdefault(stage, []).append(seconds)
+            observe_stage(stage, seconds)
+        self.db.observe_stage = record_stage
+
+        for i in range(self.args.guilds):
+            guild = FakeGuild(1000 + i, self)
+            guild.user = FakeMember(2000 + i, f"listener-{i}", voice_channel=guild.voice_channel)
+            guild.voice_channel.members.append(guild.user)
+            self.bot._connection._guilds[guild.id] = guild
+            self.guilds.append(guild)
+
+    async def monitor_loop_lag(self, interval=0.01):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.loop_lag.append(max(0, loop.time() - expected))
+
+    async def send(self, guild, content):
+        await self.db.on_message(FakeMessage(content, guild.user, guild))
+
+    async def play_guild(self, guild):
+        """
+        One guild's session: join with the first song, then queue up the rest.
+        """
+        sent_at = time.perf_counter()
+        await self.send(guild, f"!{settings.wake_phrase} play benchmark {guild.id} song 0")
+        for n in range(1, self.args.songs):
+            await self.send(guild, f"!{settings.wake_phrase} play benchmark {guild.id} song {n}")
+        while guild.voice_client is not None and not guild.voice_client.frame_times:
+            await asyncio.sleep(0.01)
+        if guild.voice_client is not None:
+            self.first_audio[guild.id] = guild.voice_client.frame_times[0] - sent_at
+
+    async def command_burst(self):
+        """
+        Fires a burst of cheap commands at every guild at once and returns the commands per second.
+        """
+        commands = []
+        for guild in self.guilds:
+            for n in range(self.args.commands):
+                verb = "queue" if n % 2 else "help"
+                commands.append(self.send(guild, f"!{settings.wake_phrase} {verb}"))
+        start = time.perf_counter()
+        await asyncio.gather(*commands)
+        return len(commands) / (time.perf_counter() - start)
+
+    async def run(self):
+        lag_task = asyncio.create_task(self.monitor_loop_lag())
+        background = [
+            asyncio.create_task(self.db.cache_janitor()),
+            asyncio.create_task(self.db.ffmpeg_watchdog()),
+            asyncio.create_task(self.db.checkpoint_playback_positions()),
+            asyncio.create_task(self.db.monitor_event_loop()),
+        ]
+        tracemalloc.start()
+        rss_before = psutil.Process().memory_info().rss
+        start = time.perf_counter()
+
+        await asyncio.gather(*(self.play_guild(guild) for guild in self.guilds))
+        commands_per_second = await self.command_burst()
+
+        # Wait for every guild to play through its queue and leave on the idle timer
+        deadline = time.perf_counter() + self.args.timeout
+        voice_clients = {guild.id: guild.voice_client for guild in self.guilds}
+        while any(vc is not None and vc.connected for vc in voice_clients.values()):
+            if time.perf_counter() > deadline:
+                print("Timed out waiting for playback to finish.", file=sys.stderr)
+                break
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - start
+
+        rss_after = psutil.Process().memory_info().rss
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        lag_task.cancel()
+        for task in background:
+            task.cancel()
+
+        idle_delays = [
+            vc.disconnected_at - vc.frame_times[-1] - self.args.idle_timeout
+            for vc in voice_clients.values()
+            if vc is not None and vc.disconnected_at is not None and vc.frame_times
+        ]
+        expected_frames = self.args.songs * self.args.song_seconds / FakeVoiceClient.FRAME_SECONDS
+        return {
+            "guilds": self.args.guilds,
+            "songs_per_guild": self.args.songs,
+            "elapsed_seconds": elapsed,
+            "commands_per_second": commands_per_second,
+            "loop_lag": self.loop_lag,
+            "time_to_first_audio": list(self.first_audio.values()),
+            "stages": self.stage_samples,
+            "stalls": [stall for vc in voice_clients.values() if vc is not None for stall in vc.stalls],
+            "frames_played_ratio": sum(
+                len(vc.frame_times) for vc in voice_clients.values() if vc is not None
+            ) / (expected_frames * len(self.guilds)),
+            "idle_disconnect_delay": idle_delays,
+            "rss_growth_bytes": rss_after - rss_before,
+            "peak_traced_bytes": peak_traced,
+            "counters": dict(self.db._counters),
+            "loop_stalls": [
+                {"site": site, "worst": stall["worst"], "count": stall["count"]}
+                for site, stall in self.db.worst_loop_stalls()
+            ],
+        }
+
+
+def print_report(results):
+    print(f"\nBenchmark: {results['guilds']} guilds x {results['songs_per_guild']} songs "
+          f"in {results['elapsed_seconds']:.1f}s")
+    print(f"  commands/sec:             {results['commands_per_second']:.0f}")
+    print(f"  event loop lag:           {describe(results['loop_lag'])}")
+    print(f"  time to first audio:      {describe(results['time_to_first_audio'])}")
+    for stage, samples in sorted(results["stages"].items()):
+        print(f"  stage {stage + ':':<19} {describe(samples)}")
+    print(f"  audio stalls:             {describe(results['stalls'])}")
+    print(f"  audio played:             {results['frames_played_ratio'] * 100:.1f}% of expected frames")
+    print(f"  idle disconnect delay:    {describe(results['idle_disconnect_delay'])}")
+    print(f"  memory:                   RSS +{results['rss_growth_bytes'] / 1024 ** 2:.1f} MiB, "
+          f"peak traced {results['peak_traced_bytes'] / 1024 ** 2:.1f} MiB")
+    print(f"  counters:                 {results['counters']}")
+    for stall in results["loop_stalls"]:
+        print(f"  loop stall:               {stall['site']}: worst {stall['worst'] * 1000:.0f}ms, {stall['count']} times")
+
+
+def main():
+    args = parse_args()
+    if shutil.which("ffmpeg") is None:
+        sys.exit("ffmpeg is required to run the benchmark.")
+
+    # Point everything the bot writes at a scratch directory, before the bot module reads its settings
+    workdir = tempfile.mkdtemp(prefix="pancrythm-bench-")
+    settings.cache_dir = os.path.join(workdir, "cache")
+    settings.cache_index_path = os.path.join(workdir, "cache_index.db")
+    settings.state_db_path = os.path.join(workdir, "bot_state.db")
+    settings.ffmpeg_pidfile = os.path.join(workdir, "ffmpeg.pids")
+    settings.idle_timeout = args.idle_timeout
+    settings.metrics_port = None
+    settings.log_level = args.log_level
+
+    import discord_bot
+
+    StubYoutubeDL.library = generate_library(workdir, args.library, args.song_seconds)
+    StubYoutubeDL.search_delay = args.search_delay
+    StubYoutubeDL.download_delay = args.download_delay
+    discord_bot.yt_dlp.YoutubeDL = StubYoutubeDL
+
+    try:
+        discord_bot.ensure_cache_dir_exists()
+        discord_bot.open_cache_index()
+        discord_bot._state_executor.submit(discord_bot.open_state_store_blocking).result()
+
+        bench = Benchmark(discord_bot, args)
+        bench.setup()
+        results = asyncio.run(bench.run())
+        print_report(results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+    finally:
+        discord_bot.terminate_ffmpeg_processes()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
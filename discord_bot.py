@@ -5,13 +5,24 @@ import discord
 import settings
 import yt_dlp
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 import re
-from mutagen import File as MutagenFile
 import threading
+import functools
+import concurrent.futures
 import psutil
 import json
+import copy
 import logging
+import time
+import sqlite3
+import subprocess
+import array
+import bisect
+import contextlib
+import traceback
+import fcntl
+import shlex
 
 # Discord bot setup and instantiation
 intents = discord.Intents.default()
@@ -19,39 +30,111 @@ intents.messages = True
 intents.message_content = True
 intents.guilds = True
 intents.voice_states = True
-bot = discord.Client(intents=intents)
+
+# Sharded deployments (settings.shard_count) run one worker process per slice of the shards; run_workers
+# starts them and tells each which shards are its own through the environment
+_worker_index = int(os.environ.get("PANCRYTHM_WORKER", 0))
+_shard_ids = [int(shard) for shard in os.environ["PANCRYTHM_SHARD_IDS"].split(",")] \
+    if os.environ.get("PANCRYTHM_SHARD_IDS") else None
+if settings.shard_count:
+    bot = discord.AutoShardedClient(intents=intents, shard_count=settings.shard_count, shard_ids=_shard_ids)
+else:
+    bot = discord.Client(intents=intents)
+
+def worker_path(path):
+    """
+    Gives each worker process its own copy of a per-process file (worker 0 keeps the original name).
+    """
+    if _worker_index == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.worker{_worker_index}{ext}"
 
 # Load our settings
 bot_name = settings.bot_name
 cache_dir = settings.cache_dir
-api_key = settings.load_discord_api_key()
 queue_limit = settings.queue_limit
+ffmpeg_pidfile = worker_path(settings.ffmpeg_pidfile)
+metrics_port = settings.metrics_port + _worker_index if settings.metrics_port else None
+
+# Startup timing, for tracking time-to-music after a deploy
+_process_start = time.monotonic()
+_startup_metrics = {"ready": None, "time_to_music": None, "guilds_restored": 0, "restore_seconds": None}
+_session_restore_task = None
 
 # Global lock for managing guild locks
 _global_lock = asyncio.Lock()
 
-# Dicts to track idle timers
-_idle_timers = {}
-_idle_timer_remaining = {}
-_idle_timer_locks = {}
+# Idle disconnect deadlines: guild_id -> (reason, asyncio.TimerHandle)
+_idle_deadlines = {}
+_intentional_disconnects = set()
 
 # Dicts to handle queues and related things
 _guild_queues = {}
 _guild_locks = {}
+_guild_channels = {}  # last text channel a play command came from, for background notices
+_now_playing = {}  # guild_id -> {"song", "source" (PositionTrackingSource)}
+_guild_players = {}  # guild_id -> GuildPlayer
+_position_checkpoint_task = None
+_prefetch_tasks = {}  # guild_id -> {id(song): prefetch task}
 
 # Add at the top with other globals
 _last_connection_attempt = {}
 _connection_failures = {}
 
-# Enable discord.py debug logging
-logging.basicConfig(level=logging.DEBUG)
-discord_logger = logging.getLogger('discord')
-discord_logger.setLevel(logging.DEBUG)
-
-# Add handler to see voice state logs
-handler = logging.StreamHandler()
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-discord_logger.addHandler(handler)
+# Worker pool for blocking yt_dlp / file work, so the event loop never waits on YouTube
+_fetch_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=settings.fetch_workers,
+    thread_name_prefix="fetch-worker"
+)
+_guild_fetch_semaphores = {}
+_guild_fetches = {}
+_inflight = {}  # single_flight key -> shared task
+_guild_fetch_generations = {}  # bumped by cancel_guild_fetches
+
+# Preferences for choose_audio_format, higher is better; Opus is what Discord plays, so it needs no transcoding
+_audio_codec_preference = {"opus": 3, "vorbis": 2, "mp4a": 1}
+_audio_container_preference = {"webm": 2, "m4a": 1}
+
+# ffmpeg child processes we started: pid -> tracking info (see track_ffmpeg_process)
+_ffmpeg_processes = {}
+_ffmpeg_lock = threading.Lock()
+_ffmpeg_watchdog_task = None
+
+# Persistent per-guild state (see open_state_store_blocking); the SQLite connection is only
+# used from the single state store thread, so writes are serialized
+_state_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-store")
+_state_db = None
+_dirty_guilds = set()
+_state_flush_task = None
+_last_state_compaction = 0
+
+# Audio cache index (see open_cache_index) and the background janitor that maintains it
+_cache_db = None
+_janitor_task = None
+_janitor_stats = {"passes": 0, "files_evicted": 0, "bytes_reclaimed": 0}
+_search_cache_stats = {"hits": 0, "misses": 0}
+
+# Pipeline metrics (see Histogram and format_metrics), served on a local HTTP endpoint
+_stage_timings = {}  # stage name -> Histogram of seconds
+_counters = {}  # event name -> count
+_metrics_lock = threading.Lock()
+_metrics_server = None
+
+# Event loop watchdog (see monitor_event_loop and loop_watchdog_thread)
+_loop_heartbeat = None  # time.monotonic() the loop last checked in
+_loop_thread_id = None
+_loop_watchdog_thread = None
+_loop_monitor_task = None
+_loop_stalls = {}  # blocking call site -> {"count", "total", "worst", "stack"}
+
+# Logging; levels come from settings so debug output costs next to nothing when it's off
+logging.basicConfig(
+    level=getattr(logging, settings.log_level.upper()),
+    format='%(asctime)s:%(levelname)s:%(name)s: %(message)s'
+)
+logging.getLogger('discord').setLevel(getattr(logging, settings.discord_log_level.upper()))
+logger = logging.getLogger('pancrythm')
 
 async def set_bot_custom_status(status_message):
     """
@@ -62,7 +145,261 @@ async def set_bot_custom_status(status_message):
     """
     activity = discord.Activity(type=discord.ActivityType.custom, name=status_message)
     await bot.change_presence(activity=activity)
-    print(f"Bot custom status set to: {status_message}")
+    logger.info("Bot custom status set to: %s", status_message)
+
+class Histogram:
+    """
+    Prometheus-style histogram of durations in seconds: how many observations fell in each bucket,
+    plus their count and sum.  observe() is safe to call from any thread (playback timings are
+    recorded on discord.py's audio thread).
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.BUCKETS, seconds)
+        with _metrics_lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket the q-quantile falls in, or None if nothing has been observed.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+def observe_stage(stage, seconds):
+    """
+    Records how long one run of a pipeline stage took.
+    """
+    histogram = _stage_timings.get(stage)
+    if histogram is None:
+        histogram = _stage_timings.setdefault(stage, Histogram())
+    histogram.observe(seconds)
+
+@contextlib.contextmanager
+def timed_stage(stage):
+    """
+    Times the block (awaits included) as one run of a pipeline stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+def increment_counter(name, amount=1):
+    """
+    Counts an event.
+    """
+    with _metrics_lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+def format_metrics():
+    """
+    Renders all metrics in the Prometheus text exposition format.
+    """
+    lines = [
+        "# HELP pancrythm_stage_seconds Time taken by each stage of the play pipeline.",
+        "# TYPE pancrythm_stage_seconds histogram"
+    ]
+    with _metrics_lock:
+        for stage, histogram in sorted(_stage_timings.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f'pancrythm_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'pancrythm_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'pancrythm_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+        counters = dict(_counters)
+
+    counters["search_cache_hits"] = _search_cache_stats["hits"]
+    counters["search_cache_misses"] = _search_cache_stats["misses"]
+    counters["janitor_files_evicted"] = _janitor_stats["files_evicted"]
+    counters["janitor_bytes_reclaimed"] = _janitor_stats["bytes_reclaimed"]
+    lines.append("# HELP pancrythm_events_total Counts of pipeline and connection events.")
+    lines.append("# TYPE pancrythm_events_total counter")
+    for name, count in sorted(counters.items()):
+        lines.append(f'pancrythm_events_total{{event="{name}"}} {count}')
+
+    gauges = {
+        "guilds": len(bot.guilds),
+        "voice_clients": len(bot.voice_clients),
+        "queued_songs": sum(len(queue) for queue in _guild_queues.values()),
+        "connection_failures": sum(_connection_failures.values()),
+        "ffmpeg_processes": len(_ffmpeg_processes),
+        # Startup timings stay unset until that point's been reached
+        "startup_ready_seconds": _startup_metrics["ready"],
+        "startup_time_to_music_seconds": _startup_metrics["time_to_music"],
+        "startup_restore_seconds": _startup_metrics["restore_seconds"],
+        "startup_guilds_restored": _startup_metrics["guilds_restored"]
+    }
+    for name, value in gauges.items():
+        if value is None:
+            continue
+        lines.append(f"# TYPE pancrythm_{name} gauge")
+        lines.append(f"pancrythm_{name} {value}")
+
+    lines.append("# HELP pancrythm_loop_stall_worst_seconds Longest the event loop was blocked at each call site.")
+    lines.append("# TYPE pancrythm_loop_stall_worst_seconds gauge")
+    for site, stall in worst_loop_stalls(limit=20):
+        site = site.replace("\\", "\\\\").replace('"', '\\"')
+        lines.append(f'pancrythm_loop_stall_worst_seconds{{site="{site}"}} {stall["worst"]:.3f}')
+    return "\n".join(lines) + "\n"
+
+def format_metrics_summary():
+    """
+    A short human-readable version of the metrics for the metrics command.
+    """
+    lines = ["**Pipeline timings** (approximate p50 / p95):"]
+    for stage, histogram in sorted(_stage_timings.items()):
+        lines.append(
+            f"{stage}: {histogram.count} runs, <= {histogram.quantile(0.5)}s / <= {histogram.quantile(0.95)}s, "
+            f"avg {histogram.sum / max(histogram.count, 1):.3f}s"
+        )
+    lines.append("**Counters:**")
+    lines.append(", ".join(f"{name} {count}" for name, count in sorted(_counters.items())) or "none yet")
+    lines.append("**Worst event loop stalls:**")
+    lines.append(format_loop_stalls() or "none yet")
+    return "\n".join(lines)
+
+async def monitor_event_loop():
+    """
+    Background task that measures event loop lag: every `settings.loop_lag_interval` seconds it wakes
+    up, records how late it woke up, and updates the heartbeat that loop_watchdog_thread watches.
+    Starts the watchdog thread the first time it runs.
+    """
+    global _loop_heartbeat, _loop_thread_id, _loop_watchdog_thread
+    _loop_thread_id = threading.get_ident()
+    _loop_heartbeat = time.monotonic()
+    if _loop_watchdog_thread is None:
+        _loop_watchdog_thread = threading.Thread(target=loop_watchdog_thread, name="loop-watchdog", daemon=True)
+        _loop_watchdog_thread.start()
+
+    while True:
+        expected = time.monotonic() + settings.loop_lag_interval
+        await asyncio.sleep(settings.loop_lag_interval)
+        _loop_heartbeat = time.monotonic()
+        observe_stage("event_loop_lag", max(0, _loop_heartbeat - expected))
+
+def loop_watchdog_thread():
+    """
+    Runs on its own thread, so it keeps going while the loop is stuck.  When the loop's heartbeat is
+    more than `settings.loop_stall_threshold` seconds late, something is blocking the loop, so the loop
+    thread's stack is grabbed right then.  Once the heartbeat comes back, the stall is recorded against
+    the call site that caused it.
+    """
+    stall = None  # (heartbeat before the stall, call site, formatted stack)
+    while True:
+        time.sleep(settings.loop_lag_interval / 2)
+        heartbeat = _loop_heartbeat
+        if stall is not None and heartbeat != stall[0]:
+            record_loop_stall(stall[1], stall[2], heartbeat - stall[0] - settings.loop_lag_interval)
+            stall = None
+        if stall is None and time.monotonic() - heartbeat > settings.loop_lag_interval + settings.loop_stall_threshold:
+            frame = sys._current_frames().get(_loop_thread_id)
+            if frame is not None:
+                stack = traceback.extract_stack(frame)
+                stall = (heartbeat, blocking_call_site(stack), "".join(traceback.format_list(stack[-8:])))
+
+def blocking_call_site(stack):
+    """
+    Names the place a stack was stuck: the innermost function of ours, and what it was calling into.
+    """
+    ours = [frame for frame in stack if frame.filename == __file__]
+    innermost = stack[-1]
+    if not ours:
+        return f"{innermost.name} ({os.path.basename(innermost.filename)}:{innermost.lineno})"
+    site = f"{ours[-1].name} (line {ours[-1].lineno})"
+    if innermost is not ours[-1]:
+        site += f" -> {innermost.name} ({os.path.basename(innermost.filename)}:{innermost.lineno})"
+    return site
+
+def record_loop_stall(site, stack, seconds):
+    """
+    Records one stall of the event loop.  Called from the watchdog thread.
+    """
+    with _metrics_lock:
+        stall = _loop_stalls.setdefault(site, {"count": 0, "total": 0.0, "worst": 0.0, "stack": stack})
+        stall["count"] += 1
+        stall["total"] += seconds
+        if seconds > stall["worst"]:
+            stall["worst"] = seconds
+            stall["stack"] = stack
+    increment_counter("event_loop_stalls")
+    observe_stage("event_loop_stall", seconds)
+    logger.warning("Event loop was blocked for %.2fs in %s:\n%s", seconds, site, stack)
+
+def worst_loop_stalls(limit=5):
+    """
+    The call sites that blocked the event loop the longest, worst first, as (site, stats) pairs.
+    """
+    with _metrics_lock:
+        stalls = [(site, dict(stall)) for site, stall in _loop_stalls.items()]
+    return sorted(stalls, key=lambda item: item[1]["worst"], reverse=True)[:limit]
+
+def format_loop_stalls(limit=3):
+    """
+    The worst event loop stalls, one per line, for the debug and metrics commands.
+    """
+    return "\n".join(
+        f"{site}: worst {stall['worst']:.2f}s, {stall['count']} times, {stall['total']:.2f}s total"
+        for site, stall in worst_loop_stalls(limit)
+    )
+
+async def start_metrics_server():
+    """
+    Serves the metrics at http://<metrics_host>:<metrics_port>/metrics for Prometheus to scrape.
+    Worker processes use consecutive ports, starting at metrics_port.
+    """
+    global _metrics_server
+    try:
+        _metrics_server = await asyncio.start_server(
+            handle_metrics_request, settings.metrics_host, metrics_port
+        )
+        logger.info("Serving metrics on http://%s:%s/metrics", settings.metrics_host, metrics_port)
+    except OSError as e:
+        logger.error("Failed to start metrics server: %s", e)
+
+async def handle_metrics_request(reader, writer):
+    """
+    Answers one HTTP request to the metrics server.
+    """
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while True:
+            header = await asyncio.wait_for(reader.readline(), timeout=5)
+            if header in (b"\r\n", b"\n", b""):
+                break
+
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", format_metrics()
+        else:
+            status, body = "404 Not Found", "Not found\n"
+        body = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
 
 def ensure_cache_dir_exists():
     """
@@ -71,51 +408,472 @@ def ensure_cache_dir_exists():
     if not os.path.exists(cache_dir):
         os.makedirs(cache_dir)
 
+def track_ffmpeg_process(process, guild_id, kind, source=None):
+    """
+    Registers an ffmpeg child process we started (kind is "playback" or "transcode"), so it can be
+    reaped when it's done and cleaned up on exit without touching anybody else's ffmpeg.
+    The PIDs are also written to the (per worker) ffmpeg pidfile in case we crash.
+    """
+    with _ffmpeg_lock:
+        _ffmpeg_processes[process.pid] = {
+            "process": process,
+            "guild_id": guild_id,
+            "kind": kind,
+            "source": source,
+            "frames": 0,
+            "stalled_since": None,
+            "terminated_at": None
+        }
+        write_ffmpeg_pidfile()
+
+def untrack_ffmpeg_process(pid):
+    """
+    Forgets an ffmpeg child process once it has exited.
+    """
+    with _ffmpeg_lock:
+        if _ffmpeg_processes.pop(pid, None) is not None:
+            write_ffmpeg_pidfile()
+
+def write_ffmpeg_pidfile():
+    """
+    Writes the PIDs of our ffmpeg children to the pidfile.  Call with _ffmpeg_lock held.
+    """
+    tmp = ffmpeg_pidfile + ".tmp"
+    with open(tmp, "w") as f:
+        f.write("\n".join(str(pid) for pid in _ffmpeg_processes))
+    os.replace(tmp, ffmpeg_pidfile)
+
+def reap_ffmpeg_processes(guild_id=None):
+    """
+    Forgets tracked ffmpeg processes (for one guild, or all) that have exited.
+    """
+    for pid, tracked in list(_ffmpeg_processes.items()):
+        if guild_id is not None and tracked["guild_id"] != guild_id:
+            continue
+        if tracked["process"].poll() is not None:
+            untrack_ffmpeg_process(pid)
+
+def kill_ffmpeg_process(pid, reason):
+    """
+    Asks a tracked ffmpeg process to exit, escalating to SIGKILL if it's still around next time.
+    """
+    tracked = _ffmpeg_processes.get(pid)
+    if tracked is None:
+        return
+    try:
+        if tracked["terminated_at"] is None:
+            tracked["process"].terminate()
+            tracked["terminated_at"] = time.monotonic()
+            logger.info("Terminated ffmpeg process with PID %s (%s)", pid, reason)
+        else:
+            tracked["process"].kill()
+            logger.warning("Killed ffmpeg process with PID %s (%s)", pid, reason)
+    except Exception as e:
+        logger.error("Failed to terminate ffmpeg process with PID %s: %s", pid, e)
+
 def terminate_ffmpeg_processes():
     """
-    Terminates any lingering ffmpeg processes.
+    Terminates the ffmpeg processes this bot started: the ones we're tracking, plus any left over in the
+    pidfile from a previous run that crashed.  Never touches ffmpeg processes that aren't ours.
     """
-    for process in psutil.process_iter(attrs=["name"]):
-        if process.info["name"] == "ffmpeg":
-            try:
+    for pid in list(_ffmpeg_processes):
+        kill_ffmpeg_process(pid, "shutting down")
+
+    try:
+        with open(ffmpeg_pidfile, "r") as f:
+            pids = [int(line) for line in f.read().split()]
+    except FileNotFoundError:
+        pids = []
+    except Exception as e:
+        logger.error("Failed to read %s: %s", ffmpeg_pidfile, e)
+        pids = []
+
+    our_start = psutil.Process().create_time()
+    for pid in pids:
+        if pid in _ffmpeg_processes:
+            continue
+        try:
+            # Make sure the PID hasn't been reused by something else since
+            process = psutil.Process(pid)
+            if process.name() == "ffmpeg" and process.create_time() < our_start:
                 process.terminate()
-                print(f"Terminated ffmpeg process with PID {process.pid}")
-            except Exception as e:
-                print(f"Failed to terminate ffmpeg process with PID {process.pid}: {e}")
-
-def save_bot_state():
-    """
-    Saves the bot's state (connected guilds and queues) to a file.
-    """
-    state = {
-        "guilds": [
-            {
-                "guild_id": guild_id,
-                "queue": _guild_queues[guild_id]
-            }
-            for guild_id in _guild_queues
-        ]
+                logger.info("Terminated leftover ffmpeg process with PID %s", pid)
+        except psutil.NoSuchProcess:
+            pass
+        except Exception as e:
+            logger.error("Failed to terminate ffmpeg process with PID %s: %s", pid, e)
+
+    with _ffmpeg_lock:
+        write_ffmpeg_pidfile()
+
+async def ffmpeg_watchdog():
+    """
+    Background task that keeps an eye on our ffmpeg children:
+      - exited processes are reaped
+      - playback processes that are neither the song playing nor the next one lined up (orphans) are terminated
+      - playback processes that haven't produced audio for `settings.ffmpeg_hang_timeout` seconds while
+        the guild is playing (hung) are terminated, which ends the song so the queue moves on
+    """
+    while True:
+        await asyncio.sleep(settings.ffmpeg_watchdog_interval)
+        now = time.monotonic()
+        for pid, tracked in list(_ffmpeg_processes.items()):
+            if tracked["process"].poll() is not None:
+                untrack_ffmpeg_process(pid)
+                continue
+            if tracked["terminated_at"] is not None:
+                kill_ffmpeg_process(pid, "didn't exit after terminate")
+                continue
+            if tracked["kind"] != "playback":
+                continue
+
+            guild_id = tracked["guild_id"]
+            player = _guild_players.get(guild_id)
+            stream = player.stream if player is not None else None
+            if stream is None or (tracked["source"] is not stream.source and tracked["source"] is not stream.next_source):
+                kill_ffmpeg_process(pid, "orphaned")
+                continue
+            if tracked["source"] is not stream.source:
+                continue  # started early for the next song, waiting its turn
+
+            guild = bot.get_guild(guild_id)
+            voice_client = guild.voice_client if guild is not None else None
+            frames = tracked["source"].frames
+            if voice_client is None or not voice_client.is_playing() or frames != tracked["frames"]:
+                # Paused, disconnected, or making progress
+                tracked["frames"] = frames
+                tracked["stalled_since"] = None
+            elif tracked["stalled_since"] is None:
+                tracked["stalled_since"] = now
+            elif now - tracked["stalled_since"] >= settings.ffmpeg_hang_timeout:
+                kill_ffmpeg_process(pid, "hung")
+
+def open_state_store_blocking():
+    """
+    Opens (creating if needed) the SQLite state store, one row per guild.  Every flush is a single
+    transaction with synchronous=FULL, so a crash mid-write can't lose or corrupt any queue.
+    Imports an old bot_state.json the first time.  Runs on the state store thread.
+    """
+    global _state_db
+    _state_db = sqlite3.connect(
+        settings.state_db_path, isolation_level=None, check_same_thread=False, timeout=settings.sqlite_busy_timeout
+    )
+    _state_db.execute("PRAGMA journal_mode=WAL")
+    _state_db.execute("PRAGMA synchronous=FULL")
+    _state_db.execute("""
+        CREATE TABLE IF NOT EXISTS guild_state (
+            guild_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            updated REAL NOT NULL
+        )
+    """)
+
+    # Migrate the old whole-file state
+    if os.path.exists("bot_state.json"):
+        try:
+            with open("bot_state.json", "r") as f:
+                state = json.load(f)
+            write_guild_states_blocking({
+                guild["guild_id"]: {"queue": guild["queue"]} if guild["queue"] else None
+                for guild in state["guilds"]
+            })
+            os.replace("bot_state.json", "bot_state.json.migrated")
+            logger.info("Migrated bot_state.json to the state store.")
+        except Exception as e:
+            logger.error("Failed to migrate bot_state.json: %s", e)
+
+def write_guild_states_blocking(states):
+    """
+    Writes {guild_id: state dict, or None to delete} to the state store in one atomic transaction.
+    Runs on the state store thread.
+    """
+    global _last_state_compaction
+    now = datetime.now().timestamp()
+    _state_db.execute("BEGIN IMMEDIATE")
+    try:
+        for guild_id, state in states.items():
+            if state is None:
+                _state_db.execute("DELETE FROM guild_state WHERE guild_id = ?", (guild_id,))
+            else:
+                _state_db.execute(
+                    "INSERT OR REPLACE INTO guild_state (guild_id, state, updated) VALUES (?, ?, ?)",
+                    (guild_id, json.dumps(state), now)
+                )
+        _state_db.execute("COMMIT")
+    except Exception:
+        _state_db.execute("ROLLBACK")
+        raise
+
+    # Fold the write-ahead log back into the database now and then so it doesn't grow forever
+    if now - _last_state_compaction >= settings.state_compact_interval:
+        _state_db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        _last_state_compaction = now
+
+def read_guild_states_blocking():
+    """
+    Reads every guild's saved state.  Runs on the state store thread.
+    """
+    return {
+        guild_id: json.loads(state)
+        for guild_id, state in _state_db.execute("SELECT guild_id, state FROM guild_state")
     }
-    with open("bot_state.json", "w") as f:
-        json.dump(state, f)
-    print("Bot state saved.")
 
-def load_bot_state():
+def guild_state_snapshot(guild_id):
+    """
+    The state we persist for a guild, or None if there's nothing worth keeping: the queue, the song
+    that's playing and how far into it we are, and which channels to come back to.
+    """
+    queue = _guild_queues.get(guild_id)
+    now_playing = _now_playing.get(guild_id)
+    if not queue and not now_playing:
+        return None
+
+    state = {"queue": list(queue or [])}
+    if now_playing:
+        state["now_playing"] = {"song": now_playing["song"], "position": playback_position(guild_id)}
+    guild = bot.get_guild(guild_id)
+    if guild is not None and guild.voice_client is not None:
+        state["voice_channel_id"] = guild.voice_client.channel.id
+    if guild_id in _guild_channels:
+        state["text_channel_id"] = _guild_channels[guild_id].id
+    return state
+
+def playback_position(guild_id):
+    """
+    How many seconds into the current song the guild is.
+    """
+    now_playing = _now_playing.get(guild_id)
+    if now_playing is None:
+        return 0
+    return now_playing["source"].position
+
+async def checkpoint_playback_positions():
+    """
+    Background task that periodically saves the playback position of every guild that's playing,
+    so a crash or restart resumes close to where it left off.
+    """
+    while True:
+        await asyncio.sleep(settings.position_save_interval)
+        for guild_id in list(_now_playing):
+            mark_guild_dirty(guild_id)
+
+class PositionTrackingSource(discord.AudioSource):
+    """
+    Wraps an audio source and counts the 20ms frames discord.py reads from it, so we know exactly
+    how far into a song playback is.  Pausing stops the reads, so pauses don't count.
+    `on_first_frame(source)`, if given, is called (on the audio thread) when the first frame is read.
+    Everything else is passed through to the wrapped source.
+    """
+    FRAME_SECONDS = 0.02
+
+    def __init__(self, original, offset=0, on_first_frame=None):
+        self.original = original
+        self.offset = offset
+        self.frames = 0
+        self.created = time.perf_counter()
+        self.on_first_frame = on_first_frame
+
+    def __getattr__(self, name):
+        return getattr(self.original, name)
+
+    @property
+    def position(self):
+        return self.offset + self.frames * self.FRAME_SECONDS
+
+    def read(self):
+        data = self.original.read()
+        if data:
+            if self.frames == 0 and self.on_first_frame is not None:
+                self.on_first_frame(self)
+            self.frames += 1
+        return data
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+class GuildAudioStream(discord.AudioSource):
+    """
+    One continuous audio source per guild, played by discord.py for as long as the queue keeps going,
+    instead of one source per song.  The next song's source is prepared ahead of time (its ffmpeg already
+    running), and when the current song runs out the stream switches to it on the very next 20ms frame,
+    so there's no gap and no ffmpeg start-up between songs.  With `settings.crossfade_seconds` set, the
+    end of one song is mixed into the start of the next.
+
+    read() runs on discord.py's audio thread and everything else on the event loop, so anything touching
+    the next song goes through a lock.  `on_transition(song, source)` is called (from the audio thread)
+    after every switch.
     """
-    Loads the bot's state (connected guilds and queues) from a file.
+
+    def __init__(self, song, source, on_transition, crossfade_seconds=0):
+        self.lock = threading.Lock()
+        self.song = song
+        self.source = source
+        self.next_song = None
+        self.next_source = None
+        self.on_transition = on_transition
+        self.crossfade_frames = int(crossfade_seconds / PositionTrackingSource.FRAME_SECONDS)
+        self.skip_requested = False
+        self.finished = False
+        self.opus = source.is_opus()
+
+    def is_opus(self):
+        return self.opus
+
+    def set_next(self, song, source):
+        """
+        Sets (or clears, with None) the song to switch to when the current one ends.
+        """
+        with self.lock:
+            if self.finished:
+                replaced = source
+            else:
+                replaced = self.next_source
+                self.next_song, self.next_source = song, source
+        if replaced is not None:
+            replaced.cleanup()
+
+    def skip(self):
+        """
+        Switches to the next song on the next frame.  Only call this when there is a next song.
+        """
+        self.skip_requested = True
+
+    def frames_remaining(self):
+        duration = self.song.get("duration")
+        if not duration:
+            return None
+        return (duration - self.source.position) / PositionTrackingSource.FRAME_SECONDS
+
+    def read(self):
+        if self.skip_requested:
+            self.skip_requested = False
+            data = b""
+        else:
+            data = self.source.read()
+
+        with self.lock:
+            if data and self.crossfade_frames and self.next_source is not None:
+                remaining = self.frames_remaining()
+                if remaining is not None and remaining <= self.crossfade_frames:
+                    incoming = self.next_source.read()
+                    if incoming:
+                        data = mix_pcm_frames(data, incoming, max(remaining, 0) / self.crossfade_frames)
+            if data:
+                return data
+
+            # The current song is over; carry on with the next one in this same frame
+            finished = self.source
+            if self.next_source is None:
+                self.finished = True
+                return b""
+            self.song, self.source = self.next_song, self.next_source
+            self.next_song = self.next_source = None
+            switch_start = time.perf_counter()
+            data = self.source.read()
+            observe_stage("transition_gap", time.perf_counter() - switch_start)
+            increment_counter("gapless_transitions")
+
+        finished.cleanup()
+        self.on_transition(self.song, self.source)
+        return data
+
+    def cleanup(self):
+        with self.lock:
+            self.finished = True
+            sources = [self.source, self.next_source]
+            self.next_song = self.next_source = None
+        for source in sources:
+            if source is not None:
+                source.cleanup()
+
+def mix_pcm_frames(outgoing, incoming, fade):
+    """
+    Mixes two frames of 16-bit PCM, `fade` (1 down to 0) of the outgoing song and the rest of the incoming one.
+    """
+    outgoing = array.array("h", outgoing)
+    incoming = array.array("h", incoming)
+    mixed = array.array("h", (int(a * fade + b * (1 - fade)) for a, b in zip(outgoing, incoming)))
+    return mixed.tobytes()
+
+def mark_guild_dirty(guild_id):
+    """
+    Notes that a guild's state changed.  Changes are written out in batches, at most
+    `settings.state_flush_delay` seconds later, and only for the guilds that changed.
+    """
+    global _state_flush_task
+    _dirty_guilds.add(guild_id)
+    if _state_flush_task is None or _state_flush_task.done():
+        _state_flush_task = asyncio.create_task(flush_bot_state_after_delay())
+
+async def flush_bot_state_after_delay():
+    """
+    Debounces state writes: waits a moment so bursts of changes become one write.  Guilds marked
+    dirty while a write was in progress get another round, since mark_guild_dirty only starts a new
+    flush when this one is finished.
+    """
+    while True:
+        await asyncio.sleep(settings.state_flush_delay)
+        await flush_bot_state()
+        if not _dirty_guilds:
+            break
+
+async def flush_bot_state():
+    """
+    Writes the state of every dirty guild to the state store, on the state store thread.
+    """
+    if not _dirty_guilds:
+        return
+    states = {guild_id: guild_state_snapshot(guild_id) for guild_id in _dirty_guilds}
+    _dirty_guilds.clear()
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(_state_executor, write_guild_states_blocking, states)
+        logger.info("Bot state saved for %s guild(s).", len(states))
+    except Exception as e:
+        logger.error("Failed to save bot state: %s", e)
+        # Try again next time
+        _dirty_guilds.update(states)
+
+def owns_guild(guild_id):
+    """
+    True if this process is connected to the guild.  In a sharded deployment the worker processes
+    share the state store, and each one must only read and write the rows of its own guilds.
+    """
+    return bot.get_guild(guild_id) is not None
+
+def save_bot_state_now():
+    """
+    Synchronously writes the state of every guild we know about.  Used on exit.
+    """
+    guild_ids = {guild_id for guild_id in set(_guild_queues) | _dirty_guilds if owns_guild(guild_id)}
+    states = {guild_id: guild_state_snapshot(guild_id) for guild_id in guild_ids}
+    _dirty_guilds.clear()
+    try:
+        _state_executor.submit(write_guild_states_blocking, states).result(timeout=10)
+        logger.info("Bot state saved.")
+    except Exception as e:
+        logger.error("Failed to save bot state: %s", e)
+
+async def load_bot_state():
+    """
+    Loads the bot's state (guilds and queues) from the state store, for the guilds this process owns.
+    Returns {guild_id: saved state}.
     """
     terminate_ffmpeg_processes()
-    global _guild_queues
+    loop = asyncio.get_running_loop()
     try:
-        with open("bot_state.json", "r") as f:
-            state = json.load(f)
-            for guild in state["guilds"]:
-                _guild_queues[guild["guild_id"]] = guild["queue"]
-        print("Bot state loaded.")
-    except FileNotFoundError:
-        print("No saved bot state found.")
+        states = await loop.run_in_executor(_state_executor, read_guild_states_blocking)
+        states = {guild_id: state for guild_id, state in states.items() if owns_guild(guild_id)}
+        for guild_id, state in states.items():
+            _guild_queues[guild_id] = state["queue"]
+        logger.info("Bot state loaded for %s guild(s).", len(states))
+        return states
     except Exception as e:
-        print(f"Failed to load bot state: {e}")
+        logger.error("Failed to load bot state: %s", e)
+        return {}
 
 @bot.event
 async def on_ready():
@@ -123,168 +881,368 @@ async def on_ready():
     await set_bot_custom_status(custom_status)
     guild_count = 0
 
-    # Load the saved state
-    load_bot_state()
+    # Start the cache janitor (on_ready can fire again after a gateway reconnect)
+    global _janitor_task, _position_checkpoint_task, _ffmpeg_watchdog_task, _loop_monitor_task
+    if _janitor_task is None or _janitor_task.done():
+        _janitor_task = asyncio.create_task(cache_janitor())
+    if _ffmpeg_watchdog_task is None or _ffmpeg_watchdog_task.done():
+        _ffmpeg_watchdog_task = asyncio.create_task(ffmpeg_watchdog())
+    if _position_checkpoint_task is None or _position_checkpoint_task.done():
+        _position_checkpoint_task = asyncio.create_task(checkpoint_playback_positions())
+    if _loop_monitor_task is None or _loop_monitor_task.done():
+        _loop_monitor_task = asyncio.create_task(monitor_event_loop())
+    if metrics_port and _metrics_server is None:
+        await start_metrics_server()
 
     for guild in bot.guilds:
-        print(f"- {guild.id} (name: {guild.name})")
+        logger.debug("- %s (name: %s)", guild.id, guild.name)
         guild_count += 1
 
-        # Reconnect to voice channels and resume playback
-        if guild.id in _guild_queues and _guild_queues[guild.id]:
-            try:
-                # Get the first voice channel in the guild
-                voice_channel = discord.utils.get(guild.voice_channels, members__contains=guild.me)
-                if voice_channel:
-                    existing_voice_client = discord.utils.get(bot.voice_clients, guild=guild)
-                    if existing_voice_client and existing_voice_client.is_connected():
-                        await existing_voice_client.disconnect(force=True)
-                    voice_client = await voice_channel.connect()
-                    print(f"Reconnected to voice channel: {voice_channel.name}")
-                    
-                    # Resume playback if there are songs in the queue
-                    next_song = _guild_queues[guild.id].pop(0)
-                    await play_song(voice_client, guild.text_channels[0], next_song)
-            except Exception as e:
-                print(f"Failed to reconnect to voice channel in guild {guild.id}: {e}")
+    logger.info("%s is on %s servers.", bot_name, guild_count)
+
+    # Load the saved state and reconnect to voice channels, once per process
+    global _session_restore_task
+    if _session_restore_task is None:
+        _startup_metrics["ready"] = time.monotonic() - _process_start
+        _session_restore_task = asyncio.create_task(restore_guild_sessions())
+
+
+async def restore_guild_sessions():
+    """
+    Loads the saved state and resumes playback in every guild that had something playing or queued,
+    reconnecting up to `settings.restore_concurrency` guilds at a time.  Records how long it took
+    from process start until music was playing again.
+    """
+    states = await load_bot_state()
+    restore_start = time.monotonic()
+    semaphore = asyncio.Semaphore(settings.restore_concurrency)
+    guilds = [guild for guild in bot.guilds if guild.id in states]
+    results = await asyncio.gather(
+        *(restore_guild_session(guild, states[guild.id], semaphore) for guild in guilds),
+        return_exceptions=True
+    )
+
+    restored = sum(1 for result in results if result is True)
+    _startup_metrics["guilds_restored"] = restored
+    _startup_metrics["restore_seconds"] = time.monotonic() - restore_start
+    logger.info(
+        "Restored %s/%s guild sessions in %.1fs (first music %ss after start).",
+        restored, len(guilds), _startup_metrics['restore_seconds'], _startup_metrics['time_to_music']
+    )
+
+async def restore_guild_session(guild, state, semaphore):
+    """
+    Reconnects to a guild's saved voice channel and resumes its song at the saved position.
+    Queued songs whose cache files have gone missing are re-fetched in the background.
+    Returns True if playback resumed.
+    """
+    guild_id = guild.id
+    now_playing = state.get("now_playing")
+    if not now_playing and not _guild_queues.get(guild_id):
+        return False
 
-    print(f"{bot_name} is on {guild_count} servers.")
+    async with semaphore:
+        try:
+            # Prefer the channels we saved; fall back to wherever we appear to be
+            voice_channel = guild.get_channel(state.get("voice_channel_id") or 0) or \
+                discord.utils.get(guild.voice_channels, members__contains=guild.me)
+            if voice_channel is None:
+                logger.info("No voice channel to restore in guild %s.", guild_id)
+                return False
+            text_channel = guild.get_channel(state.get("text_channel_id") or 0) or guild.text_channels[0]
+            _guild_channels[guild_id] = text_channel
 
+            existing_voice_client = discord.utils.get(bot.voice_clients, guild=guild)
+            if existing_voice_client and existing_voice_client.is_connected():
+                await existing_voice_client.disconnect(force=True)
+            voice_client = await voice_channel.connect()
+            logger.info("Reconnected to voice channel: %s", voice_channel.name)
+        except Exception as e:
+            logger.error("Failed to reconnect to voice channel in guild %s: %s", guild_id, e)
+            return False
+
+    # Get anything that's been evicted from the cache downloading again
+    prefetch_queue(guild_id)
+
+    # Resume the song that was playing, or start the next one in the queue
+    if now_playing:
+        song, start_at = now_playing["song"], now_playing.get("position", 0)
+    elif _guild_queues.get(guild_id):
+        song, start_at = _guild_queues[guild_id].pop(0), 0
+    else:
+        return False
+    try:
+        if not await start_song(voice_client, text_channel, song, start_at=start_at):
+            return False
+    except Exception as e:
+        logger.error("Failed to resume playback in guild %s: %s", guild_id, e)
+        return False
+
+    if _startup_metrics["time_to_music"] is None:
+        _startup_metrics["time_to_music"] = round(time.monotonic() - _process_start, 2)
+    return True
 
 @bot.event
 async def on_voice_state_update(member, before, after):
     """
     Detects when the bot disconnects from a voice channel and attempts to reconnect.
     """
+    if member != bot.user:
+        # Someone joined or left the bot's channel; that can start or stop the idle countdown
+        voice_client = member.guild.voice_client
+        if voice_client is not None and before.channel != after.channel and \
+                voice_client.channel in (before.channel, after.channel):
+            update_idle_state(voice_client)
+        return
+
     if member == bot.user:
         # Check if the bot was in a voice channel and is now disconnected
         if before.channel is not None and after.channel is None:
             guild_id = before.channel.guild.id
-            print(f"DEBUG: {bot_name} was disconnected from voice channel: {before.channel.name}")
-            print(f"DEBUG: Guild ID: {guild_id}")
-            print(f"DEBUG: Voice clients count: {len(bot.voice_clients)}")
+            cancel_idle_disconnect(guild_id)
+            logger.debug("%s was disconnected from voice channel: %s", bot_name, before.channel.name)
+            logger.debug("Guild ID: %s", guild_id)
+            logger.debug("Voice clients count: %s", len(bot.voice_clients))
             
             # Save the bot state to ensure the queue is preserved
-            save_bot_state()
-            print(f"Saved queue state for guild {guild_id}.")
+            mark_guild_dirty(guild_id)
+
+            # We left on purpose (idle timeout); don't rejoin
+            if guild_id in _intentional_disconnects:
+                _intentional_disconnects.discard(guild_id)
+                return
+
+            increment_counter("voice_disconnects")
 
             # Track connection failures
             if guild_id not in _connection_failures:
                 _connection_failures[guild_id] = 0
             _connection_failures[guild_id] += 1
             
-            print(f"DEBUG: Connection failure #{_connection_failures[guild_id]} for guild {guild_id}")
+            logger.debug("Connection failure #%s for guild %s", _connection_failures[guild_id], guild_id)
 
             # Only attempt reconnect if we haven't failed too many times recently
             if _connection_failures[guild_id] > 3:
-                print(f"DEBUG: Too many connection failures ({_connection_failures[guild_id]}), skipping reconnect")
+                logger.debug("Too many connection failures (%s), skipping reconnect", _connection_failures[guild_id])
                 return
 
-            # Attempt to reconnect if there are songs in the queue
-            if guild_id in _guild_queues and _guild_queues[guild_id]:
+            # Attempt to reconnect if a song was playing or there are songs in the queue
+            if guild_id in _now_playing or _guild_queues.get(guild_id):
                 # Add cooldown to prevent rapid reconnects
                 now = datetime.now()
                 last_attempt = _last_connection_attempt.get(guild_id, datetime.min)
                 if (now - last_attempt).total_seconds() < 30:
-                    print(f"DEBUG: Reconnect attempt throttled (last attempt {(now - last_attempt).total_seconds():.1f}s ago)")
+                    logger.debug("Reconnect attempt throttled (last attempt %.1fs ago)", (now - last_attempt).total_seconds())
                     return
                 
                 _last_connection_attempt[guild_id] = now
                 
                 try:
-                    print(f"DEBUG: Attempting to reconnect to voice channel: {before.channel.name}")
+                    logger.debug("Attempting to reconnect to voice channel: %s", before.channel.name)
                     voice_channel = before.channel
                     
                     # Clean up any existing voice clients
                     existing_voice_client = discord.utils.get(bot.voice_clients, guild=voice_channel.guild)
                     if existing_voice_client:
-                        print(f"DEBUG: Found existing voice client, disconnecting...")
+                        logger.debug("Found existing voice client, disconnecting...")
                         await existing_voice_client.disconnect(force=True)
                         await asyncio.sleep(2)  # Wait for cleanup
                     
-                    print(f"DEBUG: Connecting to voice channel...")
+                    logger.debug("Connecting to voice channel...")
                     voice_client = await voice_channel.connect()
-                    print(f"DEBUG: Successfully reconnected to voice channel: {voice_channel.name}")
+                    logger.debug("Successfully reconnected to voice channel: %s", voice_channel.name)
                     
                     # Reset failure counter on success
                     _connection_failures[guild_id] = 0
+                    increment_counter("reconnects")
                     
-                    # Resume playback if there are songs in the queue
-                    next_song = _guild_queues[guild_id].pop(0)
-                    await play_song(voice_client, voice_channel.guild.text_channels[0], next_song)
+                    # Pick the song that was cut off back up where it stopped, or start the next one
+                    text_channel = _guild_channels.get(guild_id) or voice_channel.guild.text_channels[0]
+                    if guild_id in _now_playing:
+                        song, start_at = _now_playing[guild_id]["song"], playback_position(guild_id)
+                    elif _guild_queues.get(guild_id):
+                        song, start_at = _guild_queues[guild_id].pop(0), 0
+                    else:
+                        return
+                    await start_song(voice_client, text_channel, song, start_at=start_at)
                 except Exception as e:
-                    print(f"DEBUG: Failed to reconnect to voice channel in guild {guild_id}: {e}")
-                    print(f"DEBUG: Exception type: {type(e).__name__}")
+                    logger.warning("Failed to reconnect to voice channel in guild %s: %s", guild_id, e)
+                    increment_counter("reconnect_failures")
+                    logger.debug("Exception type: %s", type(e).__name__)
 
-async def start_idle_timer(voice_client, timeout=None):
+def update_idle_state(voice_client, playing=None):
     """
-    Starts an idle timer for the bot to leave the voice channel after `timeout` seconds.
-    Also checks periodically if the bot is alone in the voice channel and disconnects if true.
+    Re-evaluates whether the bot should be counting down to leaving a voice channel, and schedules or
+    cancels the guild's disconnect deadline accordingly.  Called on events (playback start/stop,
+    pause/resume, people joining or leaving the channel) rather than polled, so it costs nothing
+    while nothing is happening:
+      - nobody but bots in the channel: leave after `settings.alone_timeout` seconds
+      - playing: no deadline
+      - paused, or nothing left to play: leave after `settings.idle_timeout` seconds
+    `playing` overrides voice_client.is_playing(), for callers that have just started or stopped playback.
     """
     guild_id = voice_client.guild.id
-    guild_name = voice_client.guild.name
-    if timeout is None:
-        timeout = settings.idle_timeout
-
-    # Ensure a lock exists for this guild's idle timer
-    if guild_id not in _idle_timer_locks:
-        _idle_timer_locks[guild_id] = asyncio.Lock()
-
-    # Cancel any existing timer for this guild
-    if guild_id in _idle_timers:
-        _idle_timers[guild_id].cancel()
-
-    async with _idle_timer_locks[guild_id]:
-        _idle_timer_remaining[guild_id] = timeout
-        print(f"Initialized idle timer for guild {guild_name} with timeout {timeout} seconds.")
-
-    async def leave_after_timeout():
-        while _idle_timer_remaining[guild_id] > 0:
-            await asyncio.sleep(1)
-            _idle_timer_remaining[guild_id] -= 1
-
-            # Check every 60 seconds if the bot is alone in the voice channel
-            if _idle_timer_remaining[guild_id] % 60 == 0:  # Grace period check
-                channel_members = voice_client.channel.members
-                non_bot_members = [member for member in channel_members if not member.bot]
-                if not non_bot_members:
-                    print(f"No users left in the voice channel {voice_client.channel.name}. Waiting for grace period.")
-                    await asyncio.sleep(60)
-                    channel_members = voice_client.channel.members
-                    non_bot_members = [member for member in channel_members if not member.bot]
-                    if not non_bot_members:
-                        print(f"No users returned to the voice channel {voice_client.channel.name}. Disconnecting.")
-                        await voice_client.disconnect()
-                        del _idle_timers[guild_id]
-                        del _idle_timer_remaining[guild_id]
-                        return
+    if not voice_client.is_connected():
+        cancel_idle_disconnect(guild_id)
+        return
 
-        # Disconnect after the idle timer expires
-        if voice_client.is_connected():
-            await voice_client.disconnect()
-            print(f"Disconnected from voice channel in guild {guild_name} due to inactivity.")
-            del _idle_timers[guild_id]
-            del _idle_timer_remaining[guild_id]
+    if playing is None:
+        playing = voice_client.is_playing()
 
-    async with _idle_timer_locks[guild_id]:
-        _idle_timers[guild_id] = asyncio.create_task(leave_after_timeout())
+    non_bot_members = [member for member in voice_client.channel.members if not member.bot]
+    if not non_bot_members:
+        schedule_idle_disconnect(voice_client, "alone", settings.alone_timeout)
+    elif playing:
+        cancel_idle_disconnect(guild_id)
+    else:
+        schedule_idle_disconnect(voice_client, "idle", settings.idle_timeout)
 
+def schedule_idle_disconnect(voice_client, reason, timeout):
+    """
+    Schedules the bot to leave the voice channel `timeout` seconds from now.  If a deadline for the
+    same reason is already pending it's left alone, so repeated events don't keep pushing it back.
+    """
+    guild_id = voice_client.guild.id
+    existing = _idle_deadlines.get(guild_id)
+    if existing is not None:
+        if existing[0] == reason:
+            return
+        existing[1].cancel()
+
+    loop = asyncio.get_running_loop()
+    handle = loop.call_at(loop.time() + timeout, on_idle_deadline, voice_client, reason)
+    _idle_deadlines[guild_id] = (reason, handle)
+    logger.info("Will leave voice in guild %s in %s seconds (%s).", voice_client.guild.name, timeout, reason)
+
+def cancel_idle_disconnect(guild_id):
+    """
+    Cancels the guild's pending idle disconnect, if there is one.
+    """
+    existing = _idle_deadlines.pop(guild_id, None)
+    if existing is not None:
+        existing[1].cancel()
+        logger.debug("Cancelled idle disconnect for guild %s.", guild_id)
 
-async def add_idle_time(guild, additional_time):
+def on_idle_deadline(voice_client, reason):
     """
-    Adds additional time to the idle timer for the specified guild.
+    Timer callback for an idle disconnect deadline.
     """
-    if guild.id in _idle_timer_remaining:
-        async with _idle_timer_locks[guild.id]:
-            _idle_timer_remaining[guild.id] += additional_time
-            print(f"Added {additional_time} seconds to the idle timer for guild {guild.name}. New remaining time: {_idle_timer_remaining[guild.id]} seconds.")
+    _idle_deadlines.pop(voice_client.guild.id, None)
+    asyncio.create_task(idle_disconnect(voice_client, reason))
+
+async def idle_disconnect(voice_client, reason):
+    """
+    Leaves the voice channel after an idle deadline expires.
+    """
+    if not voice_client.is_connected():
+        return
+    if reason == "alone":
+        logger.info("No users returned to the voice channel %s. Disconnecting.", voice_client.channel.name)
     else:
-        print(f"No active idle timer for guild {guild.name} to add time to.")
+        logger.info("Disconnected from voice channel in guild %s due to inactivity.", voice_client.guild.name)
+    # Don't let on_voice_state_update treat this as a dropped connection and rejoin
+    _intentional_disconnects.add(voice_client.guild.id)
+    await voice_client.disconnect()
+
+async def run_in_fetch_pool(guild_id, func, *args):
+    """
+    Runs a blocking function (yt_dlp search/metadata/download, file parsing) on the fetch worker pool.
+    At most `settings.fetch_per_guild` calls run at once per guild, and each call is bounded by
+    `settings.fetch_timeout`.  The function is passed a `cancel_event` keyword argument which gets set
+    if the call is cancelled (e.g. by !cake stop), so long downloads can bail out early.
+    """
+    loop = asyncio.get_running_loop()
+    if guild_id not in _guild_fetch_semaphores:
+        _guild_fetch_semaphores[guild_id] = asyncio.Semaphore(settings.fetch_per_guild)
+
+    cancel_event = threading.Event()
+    task = asyncio.current_task()
+    track_guild_fetch(guild_id, task, cancel_event)
+    try:
+        async with _guild_fetch_semaphores[guild_id]:
+            future = loop.run_in_executor(
+                _fetch_executor,
+                functools.partial(func, *args, cancel_event=cancel_event)
+            )
+            return await asyncio.wait_for(future, timeout=settings.fetch_timeout)
+    except (asyncio.CancelledError, asyncio.TimeoutError):
+        # Let the worker thread know it should stop as soon as it can
+        cancel_event.set()
+        raise
+    finally:
+        untrack_guild_fetch(guild_id, task)
+
+def track_guild_fetch(guild_id, task, cancel_event):
+    """
+    Registers a task doing fetch work for a guild, so cancel_guild_fetches can find it.
+    """
+    _guild_fetches.setdefault(guild_id, {})[task] = cancel_event
+
+def untrack_guild_fetch(guild_id, task):
+    """
+    Unregisters a task registered with track_guild_fetch.
+    """
+    guild_fetches = _guild_fetches.get(guild_id, {})
+    guild_fetches.pop(task, None)
+    if not guild_fetches:
+        _guild_fetches.pop(guild_id, None)
+
+async def single_flight(key, guild_id, func, *args):
+    """
+    Coalesces concurrent identical work: the first caller for `key` runs `func(guild_id, *args)` in a
+    shared task and everyone else asking for the same key while it's running waits on that task
+    instead of repeating the search/download.  If the shared task is cancelled because the guild that
+    started it ran !cake stop, the other waiters start the work over on their own behalf.
+    """
+    generation = _guild_fetch_generations.get(guild_id, 0)
+    while True:
+        flight = _inflight.get(key)
+        if flight is None or flight.done():
+            flight = asyncio.create_task(func(guild_id, *args))
+            _inflight[key] = flight
+            flight.add_done_callback(functools.partial(finish_flight, key))
+        else:
+            logger.debug("Joining in-flight request for %s", key)
 
-def search_youtube(query):
+        # Register ourselves so this guild's !cake stop cancels our wait
+        waiter = asyncio.current_task()
+        track_guild_fetch(guild_id, waiter, threading.Event())
+        try:
+            return await asyncio.shield(flight)
+        except asyncio.CancelledError:
+            if not flight.done() or not flight.cancelled():
+                raise  # we were cancelled, not the shared task
+            if _guild_fetch_generations.get(guild_id, 0) != generation:
+                raise  # our guild's fetches were cancelled along with the shared task
+        finally:
+            untrack_guild_fetch(guild_id, waiter)
+
+def finish_flight(key, flight):
+    """
+    Done callback for single_flight's shared tasks.
+    """
+    if _inflight.get(key) is flight:
+        del _inflight[key]
+
+def cancel_guild_fetches(guild_id):
+    """
+    Cancels any in-flight searches/downloads for the guild.
+    """
+    _guild_fetch_generations[guild_id] = _guild_fetch_generations.get(guild_id, 0) + 1
+    for task, cancel_event in list(_guild_fetches.get(guild_id, {}).items()):
+        cancel_event.set()
+        if task is not asyncio.current_task():
+            task.cancel()
+    logger.info("Cancelled pending fetches for guild %s.", guild_id)
+
+def search_youtube(query, cancel_event=None):
     """
     Searches YouTube for the given query and returns the first result.
+    Blocking; call it through run_in_fetch_pool.
     """
+    if cancel_event and cancel_event.is_set():
+        return None
+
     ydl_opts = {
         'format': 'bestaudio/best',
         'quiet': True,
@@ -297,92 +1255,679 @@ def search_youtube(query):
             info = ydl.extract_info(query, download=False)
             return info
         except Exception as e:
-            print(f"Error searching YouTube: {e}")
+            logger.error("Error searching YouTube: %s", e)
             return None 
 
-async def clean_cache():
+def open_cache_index():
     """
-    Cleans the cache directory by removing files older than 7 days.
+    Opens (creating if needed) the persistent cache index.  Each cached file is keyed by its
+    YouTube video ID and format, and the index tracks its size, duration, codec and last access
+    time so cache hits are a single primary key lookup and eviction is LRU under a byte budget.
     """
-    now = datetime.now()
-    seven_days_ago = now - timedelta(days=7)
+    global _cache_db
+    _cache_db = sqlite3.connect(settings.cache_index_path, isolation_level=None, timeout=settings.sqlite_busy_timeout)
+    _cache_db.row_factory = sqlite3.Row
+    _cache_db.execute("PRAGMA journal_mode=WAL")
+    _cache_db.execute("""
+        CREATE TABLE IF NOT EXISTS cache_entries (
+            video_id TEXT NOT NULL,
+            format TEXT NOT NULL,
+            filepath TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            duration REAL,
+            codec TEXT,
+            title TEXT,
+            last_access REAL NOT NULL,
+            loudness REAL,
+            gain_db REAL,
+            lease_until REAL,
+            PRIMARY KEY (video_id, format)
+        )
+    """)
+
+    # Indexes created by older versions of the bot don't have the loudness and lease columns yet
+    columns = {row["name"] for row in _cache_db.execute("PRAGMA table_info(cache_entries)")}
+    for column in ("loudness", "gain_db", "lease_until"):
+        if column not in columns:
+            _cache_db.execute(f"ALTER TABLE cache_entries ADD COLUMN {column} REAL")
+    _cache_db.execute("CREATE INDEX IF NOT EXISTS cache_entries_last_access ON cache_entries (last_access)")
+    _cache_db.execute("CREATE INDEX IF NOT EXISTS cache_entries_filepath ON cache_entries (filepath)")
+
+    # Search term / URL -> video, so repeat requests skip yt_dlp extraction entirely
+    _cache_db.execute("""
+        CREATE TABLE IF NOT EXISTS search_cache (
+            query TEXT PRIMARY KEY,
+            video_id TEXT NOT NULL,
+            title TEXT,
+            duration REAL,
+            webpage_url TEXT,
+            format_id TEXT,
+            ext TEXT,
+            acodec TEXT,
+            created REAL NOT NULL
+        )
+    """)
+    _cache_db.execute("CREATE INDEX IF NOT EXISTS search_cache_created ON search_cache (created)")
+    logger.info("Opened cache index %s.", settings.cache_index_path)
+
+@contextlib.contextmanager
+def cache_file_lock(filepath, cancel_event=None):
+    """
+    Holds an exclusive lock on `filepath` (through a .lock file next to it) so only one process
+    writes a cache file at a time; worker processes share the cache directory.  Yields False instead
+    if `cancel_event` gets set while waiting for another process to finish.  Blocking; only use it
+    on the fetch worker pool.
+    """
+    with open(filepath + ".lock", "w") as lock_file:
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if cancel_event and cancel_event.is_set():
+                    yield False
+                    return
+                time.sleep(0.2)
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-    # Remove files older than 7 days
-    for filename in os.listdir(cache_dir):
-        file_path = os.path.join(cache_dir, filename)
-        if os.path.isfile(file_path):
-            file_mod_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-            if file_mod_time < seven_days_ago:  # Correct condition
-                try:
-                    os.remove(file_path)
-                    print(f"Removed old cache file: {file_path}")
-                except Exception as e:
-                    print(f"Error removing file {file_path}: {e}")
+def cache_file_busy(filepath):
+    """
+    True if another process holds the cache lock on `filepath` (see cache_file_lock), i.e. it's being
+    written or converted right now.  Doesn't wait.
+    """
+    try:
+        with open(filepath + ".lock", "r") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return False
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+
+def cache_filepath(video_id, fmt, ext):
+    """
+    Returns the cache path for a video ID + format, e.g. cache/dQw4w9WgXcQ.251.webm
+    """
+    return os.path.join(cache_dir, f"{video_id}.{fmt}.{ext}")
 
-async def download_audio(url, cache_dir, title):
+def cache_lookup(video_id, fmt=None):
     """
-    Downloads the audio file using yt-dlp and saves it in the cache directory.
-    Updates the file's modification time to the current time after downloading.
+    Looks up a cached file by video ID (and format, if given; otherwise the most recently used
+    format for that video).  Marks the entry as used and leases it for `settings.cache_lease_seconds`.
+    Returns the index row (as a dict, with the lease this lookup took) or None.
     """
-    filename = "".join(c for c in title if c.isalnum() or c in (" ", "-", "_")).rstrip() + ".WebM"
-    filepath = os.path.join(cache_dir, filename)
+    if fmt is None:
+        row = _cache_db.execute(
+            "SELECT * FROM cache_entries WHERE video_id = ? ORDER BY last_access DESC LIMIT 1",
+            (video_id,)
+        ).fetchone()
+    else:
+        row = _cache_db.execute(
+            "SELECT * FROM cache_entries WHERE video_id = ? AND format = ?",
+            (video_id, fmt)
+        ).fetchone()
+    if row is None:
+        return None
+
+    # The file may have been removed (or truncated) behind our back; drop the stale entry
+    if not os.path.isfile(row["filepath"]):
+        logger.debug("Cached file missing, dropping index entry: %s", row['filepath'])
+        cache_remove(row["video_id"], row["format"])
+        return None
+    if row["size"] is not None and os.path.getsize(row["filepath"]) != row["size"]:
+        logger.warning("Cached file changed size, dropping it: %s", row['filepath'])
+        cache_remove(row["video_id"], row["format"])
+        return None
+
+    now = datetime.now().timestamp()
+    lease_until = now + settings.cache_lease_seconds
+    _cache_db.execute(
+        "UPDATE cache_entries SET last_access = ?, lease_until = ? WHERE video_id = ? AND format = ?",
+        (now, lease_until, row["video_id"], row["format"])
+    )
+    return {**dict(row), "last_access": now, "lease_until": lease_until}
 
-    # Clean the cache directory before downloading (probably aggressive but w/e)
-    await clean_cache()
+def cache_leased_elsewhere(cached):
+    """
+    True if another worker process has leased the cache entry `cached` (a cache_lookup result) since
+    this process looked it up, and that lease hasn't run out yet.
+    """
+    row = _cache_db.execute(
+        "SELECT lease_until FROM cache_entries WHERE video_id = ? AND format = ?",
+        (cached["video_id"], cached["format"])
+    ).fetchone()
+    if row is None or row["lease_until"] is None:
+        return False
+    return row["lease_until"] != cached["lease_until"] and row["lease_until"] > datetime.now().timestamp()
+
+def cache_insert(video_id, fmt, filepath, duration=None, codec=None, title=None, loudness=None, gain_db=None):
+    """
+    Records a freshly downloaded file in the cache index.  Eviction is left to the cache janitor,
+    so the play path never scans the cache.
+    """
+    size = os.path.getsize(filepath)
+    now = datetime.now().timestamp()
+    _cache_db.execute(
+        "INSERT OR REPLACE INTO cache_entries "
+        "(video_id, format, filepath, size, duration, codec, title, last_access, loudness, gain_db, lease_until) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (video_id, fmt, filepath, size, duration, codec, title, now, loudness, gain_db,
+         now + settings.cache_lease_seconds)
+    )
+    logger.debug("Cached %s (%s, %s, %s bytes) as %s", video_id, fmt, codec, size, filepath)
 
-    # Check if the file already exists in the cache
-    if os.path.exists(filepath):
-        print(f"File already exists in cache: {filepath}")
-        return filepath
+def cache_set_loudness(video_id, fmt, loudness, gain_db):
+    """
+    Records the loudness analysis for an existing cache entry.
+    """
+    _cache_db.execute(
+        "UPDATE cache_entries SET loudness = ?, gain_db = ? WHERE video_id = ? AND format = ?",
+        (loudness, gain_db, video_id, fmt)
+    )
 
-    # Use yt-dlp to download the file
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'outtmpl': filepath,
-        'quiet': True,
+def search_cache_lookup(query):
+    """
+    Looks up a normalized query in the search cache.  Returns a minimal yt_dlp-style info dict
+    (enough for download_audio) if there's an entry younger than `settings.search_cache_ttl`, else None.
+    """
+    row = _cache_db.execute(
+        "SELECT * FROM search_cache WHERE query = ? AND created >= ?",
+        (query, datetime.now().timestamp() - settings.search_cache_ttl)
+    ).fetchone()
+    if row is None:
+        _search_cache_stats["misses"] += 1
+        return None
+    _search_cache_stats["hits"] += 1
+    return {
+        "id": row["video_id"],
+        "title": row["title"],
+        "duration": row["duration"],
+        "webpage_url": row["webpage_url"],
+        "format_id": row["format_id"],
+        "ext": row["ext"],
+        "acodec": row["acodec"]
     }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+
+def search_cache_insert(query, info):
+    """
+    Remembers which video a normalized query resolved to.
+    """
+    _cache_db.execute(
+        "INSERT OR REPLACE INTO search_cache "
+        "(query, video_id, title, duration, webpage_url, format_id, ext, acodec, created) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (query, info["id"], info.get("title"), info.get("duration"), info.get("webpage_url"),
+         info.get("format_id"), info.get("ext"), info.get("acodec"), datetime.now().timestamp())
+    )
+
+def cache_remove(video_id, fmt):
+    """
+    Removes an entry from the cache index and deletes its file.
+    Returns the number of bytes reclaimed.
+    """
+    row = _cache_db.execute(
+        "SELECT filepath, size FROM cache_entries WHERE video_id = ? AND format = ?",
+        (video_id, fmt)
+    ).fetchone()
+    if row is None:
+        return 0
+    _cache_db.execute("DELETE FROM cache_entries WHERE video_id = ? AND format = ?", (video_id, fmt))
+    try:
+        os.remove(row["filepath"])
+        logger.debug("Removed cache file: %s", row['filepath'])
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error("Error removing file %s: %s", row['filepath'], e)
+    return row["size"]
+
+def cache_files_in_use():
+    """
+    The cache files this process has queued or playing, in any guild.
+    """
+    in_use = {song.get("filepath") for queue in _guild_queues.values() for song in queue}
+    in_use.update(playing["song"].get("filepath") for playing in _now_playing.values())
+    in_use.discard(None)
+    return in_use
+
+def renew_cache_leases():
+    """
+    Extends the eviction lease on every cache file this process has queued or playing.  Worker
+    processes share the cache, so evict_cache can't see each other's queues; a file whose lease
+    hasn't run out is in use somewhere and is left alone.  The janitor calls this every tick, well
+    within `settings.cache_lease_seconds`.
+    """
+    paths = list(cache_files_in_use())
+    lease_until = datetime.now().timestamp() + settings.cache_lease_seconds
+    for i in range(0, len(paths), 500):
+        chunk = paths[i:i + 500]
+        _cache_db.execute(
+            f"UPDATE cache_entries SET lease_until = ? WHERE filepath IN ({','.join('?' * len(chunk))})",
+            (lease_until, *chunk)
+        )
+
+def evict_cache():
+    """
+    Evicts least recently used cache entries until the cache fits in `settings.cache_max_bytes`, up to
+    `settings.janitor_batch_size` files at a time; only the cache janitor calls this.
+    Files that are queued or playing in any guild (in this process, or leased by another worker
+    process) are never evicted, and neither is a file another process is writing right now.
+    Returns (files evicted, bytes reclaimed).
+    """
+    total = _cache_db.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+    if total <= settings.cache_max_bytes:
+        return 0, 0
+
+    in_use = cache_files_in_use()
+    rows = _cache_db.execute(
+        "SELECT video_id, format, filepath, size FROM cache_entries "
+        "WHERE COALESCE(lease_until, 0) < ? ORDER BY last_access ASC LIMIT ?",
+        (datetime.now().timestamp(), settings.janitor_batch_size)
+    )
+    evicted = 0
+    reclaimed = 0
+    for row in rows.fetchall():
+        if total <= settings.cache_max_bytes:
+            break
+        if row["filepath"] in in_use or cache_file_busy(row["filepath"]):
+            continue
+        size = cache_remove(row["video_id"], row["format"])
+        total -= size
+        evicted += 1
+        reclaimed += size
+    logger.debug("Cache size after eviction: %s bytes (budget %s).", total, settings.cache_max_bytes)
+    return evicted, reclaimed
+
+async def cache_janitor():
+    """
+    Background task that keeps the cache directory and the cache index in sync, a bounded batch at
+    a time so no single tick does much work:
+      - files in the cache directory that aren't in the index (files from older versions of the bot,
+        abandoned downloads) are removed once they're older than `settings.cache_orphan_max_age`
+      - index entries whose files have disappeared are dropped
+      - the cache is evicted down to its byte budget
+    Every `settings.janitor_interval` seconds it looks at up to `settings.janitor_batch_size`
+    directory entries and index rows, resuming where the previous tick left off.
+    """
+    loop = asyncio.get_running_loop()
+    dir_iter = None
+    last_rowid = 0
+    pass_evicted = 0
+    pass_reclaimed = 0
+
+    while True:
+        await asyncio.sleep(settings.janitor_interval)
         try:
-            ydl.download([url])
-            print(f"Audio downloaded and saved to: {filepath}")
+            if dir_iter is None:
+                dir_iter = os.scandir(cache_dir)
 
-            # Update the file's modification time to "now"
-            now = datetime.now().timestamp()
-            os.utime(filepath, (now, now))  # Set both access and modification times to "now"
-            print(f"Updated modification time for {filepath} to {datetime.fromtimestamp(now)}")
+            # Stat the next batch of directory entries on the worker pool
+            batch = await loop.run_in_executor(
+                _fetch_executor, scan_cache_dir_batch, dir_iter, settings.janitor_batch_size
+            )
+            evicted, reclaimed = remove_orphaned_cache_files(batch)
+            pass_evicted += evicted
+            pass_reclaimed += reclaimed
+
+            renew_cache_leases()
+
+            # Check the next batch of index rows for missing files
+            rows = _cache_db.execute(
+                "SELECT rowid, video_id, format, filepath, size FROM cache_entries "
+                "WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, settings.janitor_batch_size)
+            ).fetchall()
+            for row in rows:
+                last_rowid = row["rowid"]
+                if not os.path.isfile(row["filepath"]):
+                    logger.debug("Janitor: cached file missing, dropping index entry: %s", row['filepath'])
+                    cache_remove(row["video_id"], row["format"])
+                    pass_evicted += 1
+
+            evicted, reclaimed = evict_cache()
+            pass_evicted += evicted
+            pass_reclaimed += reclaimed
+
+            # Forget expired search results
+            _cache_db.execute(
+                "DELETE FROM search_cache WHERE created < ?",
+                (datetime.now().timestamp() - settings.search_cache_ttl,)
+            )
 
-            return filepath
+            # Finished a full pass over the directory and the index
+            if len(batch) < settings.janitor_batch_size and len(rows) < settings.janitor_batch_size:
+                dir_iter.close()
+                dir_iter = None
+                last_rowid = 0
+                _janitor_stats["passes"] += 1
+                _janitor_stats["files_evicted"] += pass_evicted
+                _janitor_stats["bytes_reclaimed"] += pass_reclaimed
+                if pass_evicted:
+                    logger.info("Janitor pass complete: evicted %s files, reclaimed %s bytes.", pass_evicted, pass_reclaimed)
+                pass_evicted = 0
+                pass_reclaimed = 0
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            print(f"Failed to download audio with yt-dlp: {e}")
-            return None
+            logger.error("Error in cache janitor: %s", e)
+            if dir_iter is not None:
+                dir_iter.close()
+                dir_iter = None
+
+def scan_cache_dir_batch(dir_iter, batch_size):
+    """
+    Pulls up to `batch_size` entries from an os.scandir iterator.
+    Returns a list of (path, mtime, size) for regular files.  Blocking; runs on the worker pool.
+    """
+    batch = []
+    for entry in dir_iter:
+        try:
+            if entry.is_file():
+                stat = entry.stat()
+                batch.append((entry.path, stat.st_mtime, stat.st_size))
+        except OSError:
+            pass
+        if len(batch) >= batch_size:
+            break
+    return batch
+
+def remove_orphaned_cache_files(batch):
+    """
+    Removes files from a directory scan batch that aren't in the cache index and are older
+    than `settings.cache_orphan_max_age`.  Returns (files removed, bytes reclaimed).
+    """
+    if not batch:
+        return 0, 0
+    paths = [path for path, _, _ in batch]
+    placeholders = ",".join("?" * len(paths))
+    tracked = {row[0] for row in _cache_db.execute(
+        f"SELECT filepath FROM cache_entries WHERE filepath IN ({placeholders})", paths
+    )}
+
+    cutoff = datetime.now().timestamp() - settings.cache_orphan_max_age
+    index_path = os.path.abspath(settings.cache_index_path)
+    removed = 0
+    reclaimed = 0
+    for path, mtime, size in batch:
+        if path in tracked or mtime >= cutoff:
+            continue
+        # Don't delete the index itself if it lives in the cache directory
+        if os.path.abspath(path).startswith(index_path):
+            continue
+        try:
+            os.remove(path)
+            logger.debug("Removed old cache file: %s", path)
+            removed += 1
+            reclaimed += size
+        except Exception as e:
+            logger.error("Error removing file %s: %s", path, e)
+    return removed, reclaimed
+
+async def download_audio(guild_id, info, cache_dir):
+    """
+    Downloads the audio for a yt_dlp info dict into the cache directory, unless that video and
+    format is already cached.  The download (and loudness analysis, if enabled) runs on the fetch
+    worker pool.  Returns the song's cache index row, or None on failure.
+    """
+    video_id = info["id"]
+    fmt = info.get("format_id") or "bestaudio"
+    filepath = cache_filepath(video_id, fmt, info.get("ext") or "webm")
 
-def get_audio_duration(filepath):
+    # Check if the file already exists in the cache
+    lookup_start = time.perf_counter()
+    cached = cache_lookup(video_id, fmt)
+    if cached is not None:
+        logger.debug("File already exists in cache: %s", cached['filepath'])
+        increment_counter("cache_hits")
+        if settings.normalize_loudness and cached["gain_db"] is None:
+            # Cached before loudness analysis was turned on
+            loudness, gain_db = await analyze_loudness(guild_id, cached["filepath"])
+            cache_set_loudness(video_id, fmt, loudness, gain_db)
+            cached = cache_lookup(video_id, fmt)
+        observe_stage("cache_hit", time.perf_counter() - lookup_start)
+        return cached
+    increment_counter("cache_misses")
+
+    # Concurrent requests for the same video share one download
+    return await single_flight(("download", video_id, fmt), guild_id, download_to_cache, info, filepath, fmt)
+
+async def download_to_cache(guild_id, info, filepath, fmt):
+    """
+    Downloads a song, analyzes its loudness and adds it to the cache index.  The file only shows up
+    at `filepath` once it's complete and its length matches the video's (see
+    download_with_yt_dlp_blocking), and the index entry is only added after that, so a partially
+    written or truncated file is never treated as a cache hit.
+    Returns the song's cache index row, or None on failure.
     """
-    Attempts to extract the duration of a file using mutagen.
-    Falls back to a default duration if unable to extract.
-    Returns the duration in seconds as an integer.
+    video_id = info["id"]
+
+    # When songs get rendered to a playback file anyway, that render is done at `settings.cache_opus_bitrate`
+    # instead, so they're only encoded (and stored) once
+    compact_path = None
+    if settings.cache_opus_bitrate and not playback_render_expected():
+        compact_path = cache_filepath(video_id, fmt, "opus")
+    with timed_stage("download"):
+        filepath, probe = await run_in_fetch_pool(guild_id, download_audio_blocking, info, filepath, fmt, compact_path)
+    if not filepath:
+        return None
+
+    # Record what's actually in the file; yt_dlp's format fallbacks mean it isn't always what was asked for.
+    # The download was probed when it was checked, so this only needs ffmpeg for another worker's file
+    if probe is None:
+        probe = await run_in_fetch_pool(guild_id, probe_audio_blocking, filepath)
+    codec = probe["codec"] if probe else info.get("acodec")
+    duration = info.get("duration") or (round(probe["duration"]) if probe else None)
+
+    loudness, gain_db = None, None
+    if settings.normalize_loudness:
+        loudness, gain_db = await analyze_loudness(guild_id, filepath)
+    cache_insert(video_id, fmt, filepath, duration, codec, info.get("title"), loudness, gain_db)
+    return cache_lookup(video_id, fmt)
+
+async def analyze_loudness(guild_id, filepath):
+    """
+    Measures a file's integrated loudness (EBU R128) once, when it's added to the cache, and works
+    out the gain needed to bring it to `settings.target_loudness`.  Returns (loudness in LUFS, gain in dB);
+    both are None if the file couldn't be analyzed.
     """
     try:
-        # Use mutagen to extract the duration
-        audio = MutagenFile(filepath)
-        if audio and audio.info and audio.info.length:
-            print(f"Extracted duration for file {filepath}: {audio.info.length} seconds")
-            return int(audio.info.length)
+        loudness = await run_in_fetch_pool(guild_id, analyze_loudness_blocking, filepath)
+    except asyncio.TimeoutError:
+        logger.warning("Timed out analyzing loudness of %s", filepath)
+        loudness = None
+    if loudness is None:
+        return None, None
+    gain_db = min(settings.target_loudness - loudness, settings.max_loudness_boost)
+    logger.debug("Loudness of %s: %.1f LUFS, normalization gain %+.1f dB", filepath, loudness, gain_db)
+    return loudness, gain_db
+
+def download_audio_blocking(info, filepath, fmt, compact_path=None, cancel_event=None):
+    """
+    Downloads format `fmt` of the video in `info` to `filepath`, unless another worker process already has (or is
+    downloading it right now, in which case we wait for it).  With `compact_path`, the download is then
+    converted to Ogg Opus at `settings.cache_opus_bitrate` there, and the original is dropped.
+    Returns (path of the file to cache, its probe_audio_blocking result), or (None, None).  The probe is
+    None if the file was finished by another worker process and hasn't been probed here.
+    Blocking; call it through run_in_fetch_pool.
+    """
+    duration = info.get("duration")
+    with cache_file_lock(filepath, cancel_event) as locked:
+        if not locked:
+            return None, None
+        if compact_path and os.path.exists(compact_path):
+            logger.debug("Already downloaded by another worker: %s", compact_path)
+            return compact_path, None
+        if not os.path.exists(filepath):
+            filepath, probe = download_with_yt_dlp_blocking(info, filepath, fmt, cancel_event)
         else:
-            print(f"Mutagen could not extract duration for file: {filepath}")
-    except Exception as e:
-        print(f"Error using mutagen to extract duration for file {filepath}: {e}")
+            probe = check_download(filepath, duration, cancel_event)
+            if probe is None:
+                # Older versions of the bot wrote straight to `filepath`, so it may be a leftover partial download
+                logger.warning("Discarding incomplete cache file: %s", filepath)
+                os.remove(filepath)
+                filepath, probe = download_with_yt_dlp_blocking(info, filepath, fmt, cancel_event)
+            else:
+                logger.debug("Already downloaded by another worker: %s", filepath)
+        if filepath and compact_path:
+            compact_probe = compact_audio_blocking(filepath, compact_path, probe, cancel_event)
+            if compact_probe is not None:
+                return compact_path, compact_probe
+        return filepath, probe
+
+def compact_audio_blocking(src, dst, probe, cancel_event=None):
+    """
+    Converts a fresh download to Ogg Opus at `settings.cache_opus_bitrate` and deletes the original, so
+    the cache holds more songs and playback can pass the packets straight through.  Opus sources
+    that are already at or under that bitrate are just remuxed, since re-encoding would only lose
+    quality.  `probe` is the source's probe_audio_blocking result.  Returns what the probe of `dst` would
+    say, or None if the conversion failed (the original is kept then).
+    Blocking; call it with the source file's cache lock held.
+    """
+    bitrate = settings.cache_opus_bitrate
+    if probe["codec"] == "opus" and probe["bitrate"] and probe["bitrate"] <= bitrate:
+        bitrate = "copy"
+    if not transcode_locked_blocking(src, dst, bitrate=bitrate, cancel_event=cancel_event):
+        return None
+    logger.info(
+        "Compacted %s (%s, %s kbps, %s bytes) to %s (%s bytes)", src, probe["codec"], probe["bitrate"],
+        os.path.getsize(src), dst, os.path.getsize(dst)
+    )
+    os.remove(src)
+    return {
+        "codec": "opus",
+        "bitrate": probe["bitrate"] if bitrate == "copy" else bitrate,
+        "duration": probe["duration"]
+    }
+
+def download_with_yt_dlp_blocking(info, filepath, fmt, cancel_event=None):
+    """
+    Downloads format `fmt` of the video in `info` to `filepath` with yt-dlp.  If `info` is a full
+    extraction (it has the formats), the first attempt downloads straight from it instead of having
+    yt-dlp extract the video again; retries extract afresh, in case its stream URLs have gone stale.
+    The download goes to a temp file next to `filepath` (yt-dlp keeps its progress in a .part file
+    beside that), and is only renamed into place once its length matches the video's duration.
+    Failed or corrupt attempts are retried with exponential backoff, and a retry picks up the .part
+    file where the last attempt left off rather than starting over.  Aborts the download if
+    `cancel_event` gets set.  Returns (`filepath`, the file's probe_audio_blocking result), or (None, None).
+    Blocking; call it with the file's cache lock held.
+    """
+    def check_cancelled(_progress):
+        if cancel_event and cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled("Download cancelled")
 
-    # Fallback to default duration
-    print(f"Unable to determine duration for file: {filepath}. Using safe duration.")
-    return 600  # Default to 10 minutes if duration cannot be determined
+    url = info.get("webpage_url") or f"https://www.youtube.com/watch?v={info['id']}"
+    root, ext = os.path.splitext(filepath)
+    tmp = f"{root}.download{ext}"
+    ydl_opts = {
+        'format': f'{fmt}/bestaudio/best',
+        'outtmpl': tmp,
+        'quiet': True,
+        'progress_hooks': [check_cancelled],
+        'continuedl': True,
+        'retries': settings.download_retries,
+        'fragment_retries': settings.download_retries,
+        'retry_sleep_functions': {'http': download_retry_delay, 'fragment': download_retry_delay},
+        'concurrent_fragment_downloads': settings.download_fragments,
+    }
+    attempts = settings.download_retries + 1
+    for attempt in range(attempts):
+        if attempt:
+            delay = download_retry_delay(n=attempt - 1)
+            logger.info("Retrying download of %s in %ss (attempt %s of %s)", url, delay, attempt + 1, attempts)
+            increment_counter("download_retries")
+            if cancel_event and cancel_event.wait(delay):
+                return None, None
+            if not cancel_event:
+                time.sleep(delay)
 
-def stop_playback(voice_client):
+        try:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                if attempt == 0 and info.get("formats"):
+                    ydl.process_ie_result(copy.deepcopy(info), download=True)
+                else:
+                    ydl.download([url])
+        except yt_dlp.utils.DownloadCancelled:
+            logger.info("Download cancelled: %s", url)
+            return None, None
+        except Exception as e:
+            logger.warning("Download attempt %s of %s failed: %s", attempt + 1, url, e)
+            continue
+
+        probe = check_download(tmp, info.get("duration"), cancel_event)
+        if probe is None:
+            logger.warning("Downloaded file is incomplete or corrupt, discarding it: %s", tmp)
+            increment_counter("corrupt_downloads")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            continue
+
+        os.replace(tmp, filepath)
+        logger.info("Audio downloaded and saved to: %s", filepath)
+
+        # Update the file's modification time to "now"
+        now = datetime.now().timestamp()
+        os.utime(filepath, (now, now))  # Set both access and modification times to "now"
+        logger.debug("Updated modification time for %s to %s", filepath, datetime.fromtimestamp(now))
+        return filepath, probe
+
+    logger.error("Failed to download audio with yt-dlp after %s attempts: %s", attempts, url)
+    return None, None
+
+def download_retry_delay(n):
     """
-    Stops the audio playback in the voice client.
+    Seconds to wait before retry number `n` (counting from 0) of a download: exponential backoff from
+    `settings.download_retry_backoff`.  yt-dlp calls this by keyword (as a retry_sleep_functions entry),
+    so the parameter has to be called `n`.
     """
-    if voice_client.is_playing():
-        voice_client.stop()
+    return settings.download_retry_backoff * 2 ** n
+
+def check_download(filepath, duration=None, cancel_event=None):
+    """
+    Checks that a downloaded file is readable audio whose length is within `settings.duration_tolerance`
+    seconds of `duration` (the length YouTube reports), or just readable audio if we don't know that.
+    Returns the file's probe_audio_blocking result if it checks out, else None.
+    Blocking; runs on the fetch worker pool.
+    """
+    probe = probe_audio_blocking(filepath, cancel_event)
+    if probe is None:
+        return None
+    if duration and abs(probe["duration"] - duration) > settings.duration_tolerance:
+        return None
+    if probe["duration"] <= 0:
+        return None
+    return probe
+
+def probe_audio_blocking(filepath, cancel_event=None):
+    """
+    Reads through all of a file's audio packets with ffmpeg (without decoding them) to find out what's
+    really in it.  Returns a dict with the audio "codec", the overall "bitrate" in kbps (None if
+    ffmpeg doesn't report one) and the "duration" in seconds, measured from the packets, so unlike
+    the duration in the file's header it comes up short for a truncated download.
+    Returns None if the file can't be read.  Blocking; runs on the fetch worker pool.
+    """
+    args = [
+        "ffmpeg", "-hide_banner", "-i", filepath, "-map", "0:a:0", "-c", "copy", "-f", "null", "-"
+    ]
+    try:
+        stderr = run_ffmpeg_blocking(args, cancel_event)
+    except Exception as e:
+        logger.warning("Couldn't read %s: %s", filepath, str(e).splitlines()[-1:])
+        return None
+    times = re.findall(r"time=(\d+):(\d+):(\d+(?:\.\d+)?)", stderr)
+    codec = re.search(r"Audio: (\w+)", stderr)
+    if not times or not codec:
+        return None
+    bitrate = re.search(r"bitrate: (\d+) kb/s", stderr)
+    hours, minutes, seconds = times[-1]
+    return {
+        "codec": codec.group(1),
+        "bitrate": int(bitrate.group(1)) if bitrate else None,
+        "duration": int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    }
 
 async def handle_stop_command(voice_client, channel):
     """
@@ -394,42 +1939,53 @@ async def handle_stop_command(voice_client, channel):
     # Clear the queue
     if guild_id in _guild_queues:
         _guild_queues[guild_id].clear()
+    _now_playing.pop(guild_id, None)
+    mark_guild_dirty(guild_id)
+
+    # Abandon any searches/downloads still running for this guild
+    cancel_guild_fetches(guild_id)
+    for task in _prefetch_tasks.pop(guild_id, {}).values():
+        task.cancel()
 
     # Remove the lock for this guild
     if guild_id in _guild_locks:
         del _guild_locks[guild_id]
 
-    stop_playback(voice_client)
+    cancel_idle_disconnect(guild_id)
+    get_guild_player(voice_client).stop()
+    _guild_players.pop(guild_id, None)
     await voice_client.disconnect()
     await channel.send("Stopped audio playback, cleared the queue.")
-    print("Disconnected from voice channel and cleared the queue.")
+    logger.info("Disconnected from voice channel and cleared the queue.")
 
 async def handle_pause_command(voice_client, channel):
     """
     Pauses the audio playback in the voice client.
     """
-    if voice_client.is_playing():
-        voice_client.pause()
-        print("Paused audio playback.")
+    if get_guild_player(voice_client).pause():
+        logger.debug("Paused audio playback.")
     else:
         await channel.send("Audio is not currently playing.")
-        print("No audio is currently playing.")
+        logger.debug("No audio is currently playing.")
 
 async def handle_resume_command(voice_client, channel):
     """
     Resumes the audio playback in the voice client.
     """
-    if voice_client.is_paused():
-        voice_client.resume()
-        print("Resumed audio playback.")
+    if get_guild_player(voice_client).resume():
+        logger.debug("Resumed audio playback.")
     else:
         await channel.send("Audio is not paused.")
-        print("Audio is not paused.")
+        logger.debug("Audio is not paused.")
 
-def get_title_from_url(url):
+def get_info_from_url(url, cancel_event=None):
     """
-    Extracts the title of a YouTube video given its URL using yt_dlp.
+    Extracts the info (ID, title, duration, formats) of a YouTube video given its URL using yt_dlp.
+    Blocking; call it through run_in_fetch_pool.
     """
+    if cancel_event and cancel_event.is_set():
+        return None
+
     ydl_opts = {
         'quiet': True,
         'format': 'bestaudio/best',
@@ -438,168 +1994,1018 @@ def get_title_from_url(url):
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         try:
             info = ydl.extract_info(url, download=False)
-            print(f"Got title from URL: {info.get('title', 'Unknown Title')}")
-            return info.get('title', 'Unknown Title')
+            logger.debug("Got title from URL: %s", info.get('title', 'Unknown Title'))
+            return info
         except Exception as e:
-            print(f"Error extracting title from URL: {e}")
+            logger.error("Error extracting info from URL: %s", e)
             return None
 
-def play_audio_in_thread(voice_client, audio_source, message_channel):
+class GuildPlayer:
     """
-    Plays audio in a separate thread to avoid blocking the main event loop.
-    Cleans up the thread after playback ends.
+    Owns a guild's playback lifecycle: starting songs, stopping, skipping, pausing and resuming, and
+    turning the callbacks discord.py makes on its audio thread into handle_song_transition and
+    handle_song_end calls on the event loop.  voice_client.play() doesn't block, so no threads are
+    started here.  Songs play through one GuildAudioStream, so moving on to a prepared next song
+    doesn't involve discord.py at all.  Every start and stop bumps a generation number, so a late
+    callback from a stream that was replaced or stopped is ignored.
     """
-    def playback():
-        try:
-            # Play the audio
-            voice_client.play(
-                audio_source,
-                after=lambda e: asyncio.run_coroutine_threadsafe(
-                    handle_song_end(voice_client, message_channel),
-                    bot.loop
-                )
-            )
-        except Exception as e:
-            print(f"Error during playback: {e}")
 
-    # Start the playback in a new thread
-    playback_thread = threading.Thread(target=playback, daemon=True)
-    playback_thread.start()
-    save_bot_state()
+    def __init__(self, voice_client):
+        self.voice_client = voice_client
+        self.loop = asyncio.get_running_loop()
+        self.generation = 0
+        self.stream = None
+        self.message_channel = None
+
+    def play(self, song, audio_source, message_channel):
+        """
+        Starts a new stream playing `audio_source`, replacing whatever is playing now.
+        """
+        if self.voice_client.is_playing() or self.voice_client.is_paused():
+            self.stop()
+        self.generation += 1
+        generation = self.generation
+        self.message_channel = message_channel
+        self.stream = GuildAudioStream(
+            song,
+            audio_source,
+            on_transition=lambda song, source: self.loop.call_soon_threadsafe(self.song_changed, generation, song, source),
+            crossfade_seconds=settings.crossfade_seconds
+        )
+        self.voice_client.play(
+            self.stream,
+            after=lambda error: self.loop.call_soon_threadsafe(
+                self.song_ended, generation, error, message_channel, time.perf_counter()
+            )
+        )
+        mark_guild_dirty(self.voice_client.guild.id)
+
+    def song_changed(self, generation, song, source):
+        """
+        Runs on the event loop after the stream has moved on to the next song by itself.
+        """
+        if generation != self.generation:
+            return
+        asyncio.create_task(handle_song_transition(self.voice_client, self.message_channel, song, source))
+
+    def song_ended(self, generation, error, message_channel, ended_at):
+        """
+        Runs on the event loop when the stream runs out (nothing was lined up next) or is stopped.
+        """
+        if error:
+            logger.error("Error during playback: %s", error)
+        if generation != self.generation:
+            return  # stopped or replaced on purpose; not a real song end
+        asyncio.create_task(handle_song_end(self.voice_client, message_channel, ended_at))
+
+    def stop(self):
+        """
+        Stops playback without moving on to the next song.
+        """
+        self.generation += 1
+        if self.voice_client.is_playing() or self.voice_client.is_paused():
+            self.voice_client.stop()
+
+    def skip(self):
+        """
+        Ends the current song early.  If the next song is lined up the stream switches to it right away,
+        otherwise the stream ends and the song-end callback moves on to the next one.
+        """
+        if self.voice_client.is_playing() and self.stream is not None and self.stream.next_source is not None:
+            self.stream.skip()
+        elif self.voice_client.is_playing() or self.voice_client.is_paused():
+            self.voice_client.stop()
+
+    def pause(self):
+        """
+        Pauses playback.  Returns False if nothing was playing.
+        """
+        if not self.voice_client.is_playing():
+            return False
+        self.voice_client.pause()
+        update_idle_state(self.voice_client, playing=False)
+        mark_guild_dirty(self.voice_client.guild.id)
+        return True
+
+    def resume(self):
+        """
+        Resumes paused playback.  Returns False if nothing was paused.
+        """
+        if not self.voice_client.is_paused():
+            return False
+        self.voice_client.resume()
+        update_idle_state(self.voice_client, playing=True)
+        return True
+
+def get_guild_player(voice_client):
+    """
+    Returns the guild's playback controller, pointed at its current voice client.
+    """
+    guild_id = voice_client.guild.id
+    if guild_id not in _guild_players:
+        _guild_players[guild_id] = GuildPlayer(voice_client)
+    player = _guild_players[guild_id]
+    player.voice_client = voice_client
+    return player
 
-async def play_song(voice_client, message_channel, song):
+def normalize_query(query):
+    """
+    Normalizes a search term or URL so trivially different spellings of the same request match.
+    URLs are trimmed at the first '&'; search terms are normalized per `settings.query_normalization`:
+      - "whitespace": collapse runs of whitespace and trim the ends
+      - "case": ignore upper/lower case
+      - "punctuation": ignore punctuation
+    """
+    query = query.strip()
+    if re.match(r"(https?://)?(www\.)?(youtube\.com|youtu\.be)/.+", query):
+        return query.split("&")[0]
+    rules = settings.query_normalization
+    if "punctuation" in rules:
+        query = "".join(c for c in query if c.isalnum() or c.isspace())
+    if "whitespace" in rules:
+        query = " ".join(query.split())
+    if "case" in rules:
+        query = query.casefold()
+    return query
+
+async def resolve_query(guild_id, query):
+    """
+    Resolves a search term or YouTube URL to a yt_dlp info dict for a single video.
+    Recently resolved queries come straight from the search cache; concurrent requests for the
+    same query share one search.
+    Returns (info, None) on success, or (None, error message for the user) on failure.
+    """
+    normalized = normalize_query(query)
+    cached = search_cache_lookup(normalized)
+    if cached is not None:
+        logger.debug("Search cache hit: %s -> %s", query, cached['id'])
+        return cached, None
+
+    entry, error = await single_flight(("resolve", normalized), guild_id, fetch_query_info, query)
+    if entry is not None:
+        search_cache_insert(normalized, entry)
+    return entry, error
+
+async def fetch_query_info(guild_id, query):
     """
-    Plays a song and handles the queue.
+    Does the actual yt_dlp work for resolve_query.
     """
-    # Start the idle timer
-    await start_idle_timer(voice_client)  # Ensure the timer is initialized first
+    # Check if the query is a YouTube URL
+    youtube_url_pattern = r"(https?://)?(www\.)?(youtube\.com|youtu\.be)/.+"
+    is_url = re.match(youtube_url_pattern, query)
 
-    # Add the song's duration to the idle timer
-    await add_idle_time(voice_client.guild, song["duration"])
+    if is_url:
+        url = query.split("&")[0]
+        logger.debug("Detected YouTube URL: %s", url)
+        try:
+            with timed_stage("metadata"):
+                entry = await run_in_fetch_pool(guild_id, get_info_from_url, url)
+        except asyncio.TimeoutError:
+            logger.warning("Timed out extracting info from URL: %s", url)
+            entry = None
+        if entry is None:
+            return None, "Couldn't get any information for that URL."
+        if not choose_audio_format(entry):
+            return None, "No playable formats found for that URL."
+        return entry, None
+
+    # Perform a YouTube search if it's not a URL
+    try:
+        with timed_stage("search"):
+            info = await run_in_fetch_pool(guild_id, search_youtube, query)
+    except asyncio.TimeoutError:
+        logger.warning("Timed out searching YouTube for: %s", query)
+        info = None
+    if info is None:
+        logger.warning("No information returned from YouTube search.")
+        return None, "No results found for your query."
+
+    # Navigate to the correct entry and formats
+    if 'entries' not in info or not info['entries']:
+        logger.error("Error: 'entries' key not found or empty in the info dictionary.")
+        return None, "No results found for your query."
+
+    entry = info['entries'][0]
+    if not choose_audio_format(entry):
+        logger.error("Error: no playable formats in the first entry.")
+        return None, "No playable formats found for your query."
+
+    logger.debug("Title: %s", entry.get('title', 'Unknown Title'))
+    return entry, None
+
+def rank_audio_format(fmt):
+    """
+    Sort key for choose_audio_format: audio-only before formats with video, then yt-dlp's own
+    judgement (the original audio track before dubs, no dynamic range compression, its quality and
+    source preferences), and only then by codec (Opus, then Vorbis, then AAC, then anything else),
+    bitrate and container (WebM, then M4A).
+    """
+    codec = (fmt.get("acodec") or "").split(".")[0]
+    return (
+        fmt.get("vcodec") == "none",
+        fmt.get("language_preference") or 0,
+        not fmt.get("has_drc"),
+        fmt.get("quality") or 0,
+        fmt.get("source_preference") or 0,
+        _audio_codec_preference.get(codec, 0),
+        fmt.get("abr") or fmt.get("tbr") or 0,
+        _audio_container_preference.get(fmt.get("ext"), 0)
+    )
 
-    # Send a message to the text channel before playing
-    await message_channel.send(f"Now playing: {song['title']}")
+def choose_audio_format(entry):
+    """
+    Picks the best format of a yt_dlp info dict to play (see rank_audio_format) and copies its ID,
+    container, codec, bitrate, stream URL and HTTP headers to the top level of the dict, where
+    download_audio, prepare_stream and the search cache read them.  The choice is remembered with
+    the rest of the entry in the search cache, so later plays use the same format (and cache file).
+    Returns False if the video has no formats with audio.
+    """
+    formats = [
+        fmt for fmt in entry.get("formats") or []
+        if fmt.get("acodec") not in (None, "none") and fmt.get("url")
+    ]
+    if not formats:
+        return False
+    best = max(formats, key=rank_audio_format)
+    for key in ("format_id", "ext", "acodec", "abr", "url", "http_headers"):
+        entry[key] = best.get(key)
+    logger.debug(
+        "Chose format %s (%s, %s, %s kbps)", best.get("format_id"), best.get("ext"), best.get("acodec"), best.get("abr")
+    )
+    return True
 
-    # Play the audio with volume control from the cached file
-    volume = settings.volume
-    ffmpeg_options = {
-        'options': f'-filter:a "volume={volume}" -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+def new_song(query):
+    """
+    Creates a queue entry for a query that hasn't been resolved yet.  The prefetcher (or play_song,
+    if it gets there first) fills in the title, video ID, file path and duration.
+    """
+    return {
+        "title": query,
+        "query": query,
+        "video_id": None,
+        "url": None,
+        "filepath": None,
+        "duration": None
     }
 
-    audio_source = discord.FFmpegPCMAudio(
-        song["filepath"],
-        **ffmpeg_options
-    )
+def is_song_ready(song):
+    """
+    True if the song has been resolved and downloaded to the cache.
+    """
+    return bool(song.get("filepath")) and os.path.isfile(song["filepath"])
 
-    play_audio_in_thread(voice_client, audio_source, message_channel)
+async def prepare_song(guild_id, song, entry=None):
+    """
+    Resolves and downloads a queue entry (and, if `settings.prefetch_transcode` is set, transcodes it
+    to Opus), filling in the song dict in place.  Pass `entry` if the song's already been resolved,
+    so its yt_dlp info dict is reused for the download.  Returns None on success or an error message.
+    """
+    # Songs restored from an older state file, or whose cache file was evicted, get re-resolved
+    if entry is None:
+        query = song.get("query") or song.get("url") or song["title"]
+        entry, error = await resolve_query(guild_id, query)
+        if entry is None:
+            return error
+
+    # A playback-ready file rendered at the current settings is all we need (its source is deleted once
+    # it's rendered), so check for that before looking for the download
+    fmt = playback_format_key()
+    rendered = cache_lookup(entry["id"], fmt)
+    if rendered is not None:
+        gain_db = (rendered["gain_db"] or 0.0) if settings.normalize_loudness else 0.0
+        song.update({
+            "title": entry.get('title', "Unknown Title"),
+            "video_id": entry["id"],
+            "url": entry.get("webpage_url"),
+            "filepath": rendered["filepath"],
+            "duration": rendered["duration"] or entry.get('duration') or 600,
+            "codec": "opus",
+            "gain_db": gain_db,
+            "gain": playback_gain_for(gain_db)
+        })
+        return None
+
+    # Download the audio file to the cache directory (keyed by video ID, so the same
+    # video reached by search or by URL is only stored once)
+    try:
+        cached = await download_audio(guild_id, entry, cache_dir)
+    except asyncio.TimeoutError:
+        logger.warning("Timed out downloading audio: %s", entry.get('webpage_url'))
+        cached = None
+    if cached is None:
+        return "Failed to download audio."
+    filepath = cached["filepath"]
+
+    # Fall back to the length ffmpeg measured when the file was cached; mutagen can't read WebM
+    duration = entry.get('duration') or cached["duration"]
+    if not duration:
+        probe = await run_in_fetch_pool(guild_id, probe_audio_blocking, filepath)
+        duration = round(probe["duration"]) if probe else 600
+
+    # Render a playback-ready Opus file with the volume (and loudness normalization) baked in, so
+    # playback can pass the Opus packets straight through to Discord without any filter graph
+    codec = cached["codec"] or entry.get("acodec")
+    gain_db = (cached["gain_db"] or 0.0) if settings.normalize_loudness else 0.0
+    target_gain = playback_gain_for(gain_db)
+    gain = 1.0
+    if (settings.prefetch_transcode or codec != "opus" or abs(target_gain - 1.0) >= 0.001
+            or (settings.cache_opus_bitrate and playback_render_expected())):
+        rendered = await single_flight(
+            ("render", entry["id"], fmt), guild_id, render_playback_file,
+            entry, cached, fmt, duration, gain_db, target_gain
+        )
+        if rendered is not None:
+            filepath, codec, gain = rendered["filepath"], "opus", target_gain
+
+    song.update({
+        "title": entry.get('title', "Unknown Title"),
+        "video_id": entry["id"],
+        "url": entry.get("webpage_url"),
+        "filepath": filepath,
+        "duration": duration,
+        "codec": codec,
+        "gain_db": gain_db,
+        "gain": gain
+    })
+    return None
+
+async def render_playback_file(guild_id, entry, cached, fmt, duration, gain_db, target_gain):
+    """
+    Transcodes a cached song to a playback-ready Opus file at `target_gain` and adds it to the
+    cache index in place of the download it was made from, so songs aren't stored twice (if the
+    volume or loudness settings change, the song is downloaded again).
+    Returns the new index row, or None on failure.
+    """
+    opus_path = cache_filepath(entry["id"], fmt, "opus")
+    try:
+        transcoded = await run_in_fetch_pool(
+            guild_id, transcode_to_opus_blocking, cached["filepath"], opus_path, target_gain, settings.cache_opus_bitrate
+        )
+    except asyncio.TimeoutError:
+        logger.warning("Timed out transcoding %s", cached['filepath'])
+        transcoded = None
+    if not transcoded:
+        return None
+    cache_insert(entry["id"], fmt, opus_path, duration, "opus", entry.get("title"), cached["loudness"], gain_db)
+    # Keep the download if any worker still has it queued or playing, or is writing to it
+    if (cached["filepath"] not in cache_files_in_use() and not cache_leased_elsewhere(cached)
+            and not cache_file_busy(cached["filepath"])):
+        cache_remove(entry["id"], cached["format"])
+    return cache_lookup(entry["id"], fmt)
+
+def playback_gain_for(gain_db):
+    """
+    The linear gain a song should be played at: the volume setting plus its loudness normalization gain.
+    """
+    if not settings.normalize_loudness:
+        gain_db = 0.0
+    return settings.volume * 10 ** (gain_db / 20)
 
-async def handle_song_end(voice_client, message_channel):
+def playback_format_key():
     """
-    Handles the end of a song and plays the next song in the queue if available.
-    Resets the idle timer back to the default timeout only if the queue is empty.
+    Cache format key for playback-ready Opus files rendered at the current volume, loudness
+    normalization and cache bitrate settings.
     """
-    guild_id = voice_client.guild.id
-    guild_name = voice_client.guild.name
+    fmt = "opus"
+    if settings.normalize_loudness:
+        fmt += f"-norm{settings.target_loudness:g}"
+    if settings.volume != 1.0:
+        fmt += f"-vol{settings.volume:g}"
+    if settings.cache_opus_bitrate:
+        fmt += f"-{settings.cache_opus_bitrate}k"
+    return fmt
+
+def playback_render_expected():
+    """
+    True if the current settings mean songs are normally rendered to a playback file (see prepare_song)
+    rather than played from the download as it is.
+    """
+    return settings.prefetch_transcode or settings.volume != 1.0 or settings.normalize_loudness
 
-    async with _guild_locks[guild_id]:
-        if guild_id in _guild_queues and _guild_queues[guild_id]:
-            # Play the next song in the queue
-            next_song = _guild_queues[guild_id].pop(0)
+def run_ffmpeg_blocking(args, cancel_event=None):
+    """
+    Runs an ffmpeg command to completion, killing it if `cancel_event` gets set.
+    Returns ffmpeg's stderr output; raises RuntimeError if ffmpeg fails or is cancelled.
+    """
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    track_ffmpeg_process(process, None, "transcode")
+    try:
+        while True:
             try:
-                await play_song(voice_client, message_channel, next_song)
-            except Exception as e:
-                print(f"Error playing next song: {e}")
+                _, stderr = process.communicate(timeout=1)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel_event and cancel_event.is_set():
+                    process.kill()
+                    process.wait()
+                    raise RuntimeError("ffmpeg cancelled")
+    finally:
+        untrack_ffmpeg_process(process.pid)
+    stderr = stderr.decode(errors="replace")
+    if process.returncode != 0:
+        raise RuntimeError(stderr.strip())
+    return stderr
+
+def analyze_loudness_blocking(filepath, cancel_event=None):
+    """
+    Runs ffmpeg's loudnorm filter in analysis mode over a file and returns its integrated loudness
+    in LUFS, or None if it couldn't be measured.  Blocking; call it through run_in_fetch_pool.
+    """
+    args = [
+        "ffmpeg", "-hide_banner", "-nostats", "-i", filepath, "-vn",
+        "-af", "loudnorm=print_format=json", "-f", "null", "-"
+    ]
+    try:
+        stderr = run_ffmpeg_blocking(args, cancel_event)
+        report = json.loads(stderr[stderr.rindex("{"):stderr.rindex("}") + 1])
+        loudness = float(report["input_i"])
+        if loudness == float("-inf"):
+            return None  # silence; nothing to normalize
+        return loudness
+    except Exception as e:
+        logger.error("Failed to analyze loudness of %s: %s", filepath, e)
+        return None
+
+def transcode_to_opus_blocking(src, dst, volume=1.0, bitrate=None, cancel_event=None):
+    """
+    Transcodes `src` to an Ogg Opus file at `dst` with ffmpeg, scaling it by `volume`, at `bitrate` kbps
+    (`settings.opus_bitrate` by default; "copy" remuxes Opus audio without re-encoding it).  Writes to a
+    temp file first so a half-written file is never picked up, with the cache lock on `dst` held so
+    worker processes don't transcode the same file at once.  Blocking; call it through run_in_fetch_pool.
+    """
+    with cache_file_lock(dst, cancel_event) as locked:
+        if not locked:
+            return None
+        if os.path.exists(dst):
+            return dst
+        return transcode_locked_blocking(src, dst, volume, bitrate, cancel_event)
+
+def transcode_locked_blocking(src, dst, volume=1.0, bitrate=None, cancel_event=None):
+    """
+    Does the work for transcode_to_opus_blocking.
+    """
+    tmp = dst + ".tmp"
+    args = ["ffmpeg", "-y", "-loglevel", "error", "-i", src, "-vn"]
+    if bitrate == "copy":
+        args += ["-c:a", "copy"]
+    else:
+        if volume != 1.0:
+            args += ["-filter:a", f"volume={volume}"]
+        args += ["-c:a", "libopus", "-b:a", f"{bitrate or settings.opus_bitrate}k", "-ar", "48000", "-ac", "2"]
+    args += ["-f", "ogg", tmp]
+    try:
+        run_ffmpeg_blocking(args, cancel_event)
+        os.replace(tmp, dst)
+        logger.debug("Transcoded %s to %s", src, dst)
+        return dst
+    except Exception as e:
+        logger.error("Failed to transcode %s to Opus: %s", src, e)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return None
+
+async def ensure_song_ready(guild_id, song):
+    """
+    Makes sure a song is downloaded, waiting on its prefetch if one is running.
+    Returns None if the song is ready to play, or an error message.
+    """
+    if is_song_ready(song):
+        return None
+    task = _prefetch_tasks.get(guild_id, {}).get(id(song))
+    if task is not None:
+        try:
+            error = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            error = "Download was cancelled."
+        if is_song_ready(song):
+            return None
+        return error or "Failed to download audio."
+    return await prepare_song(guild_id, song)
+
+async def prepare_stream(guild_id, song):
+    """
+    Gets a song ready to start playing right away.  If it's already cached, it's simply made ready
+    from the cache.  Otherwise this resolves a direct stream URL for it and starts the cache download
+    in the background, so playback doesn't have to wait for the whole file; once the download is
+    done, later plays use the cached file.
+    Returns (stream dict with "url" and "headers", None) to play from the stream, (None, None) if the
+    song is ready to play from the cache, or (None, error message).
+    """
+    query = song.get("query") or song.get("url") or song["title"]
+    entry, error = await resolve_query(guild_id, query)
+    if entry is None:
+        return None, error
+    if cache_lookup(entry["id"]) is not None:
+        return None, await ensure_song_ready(guild_id, song)
+
+    # Search cache hits don't carry a stream URL (they expire), so get a fresh one
+    if not entry.get("url"):
+        try:
+            with timed_stage("metadata"):
+                entry = await run_in_fetch_pool(guild_id, get_info_from_url, entry["webpage_url"])
+        except asyncio.TimeoutError:
+            entry = None
+        if not entry or not choose_audio_format(entry):
+            return None, await ensure_song_ready(guild_id, song)
+
+    song.update({
+        "title": entry.get("title", song["title"]),
+        "video_id": entry["id"],
+        "url": entry.get("webpage_url"),
+        "duration": entry.get("duration")
+    })
+    start_prefetch(guild_id, song, entry)
+    increment_counter("streamed_starts")
+    return {"url": entry["url"], "headers": entry.get("http_headers") or {}}, None
+
+def prefetch_queue(guild_id):
+    """
+    Starts background downloads for the next `settings.prefetch_count` songs in the guild's queue,
+    so they're ready to go by the time the current song ends.
+    """
+    queue = _guild_queues.get(guild_id, [])
+    for song in queue[:settings.prefetch_count]:
+        start_prefetch(guild_id, song)
+
+def start_prefetch(guild_id, song, entry=None):
+    """
+    Starts downloading a song in the background, unless it's ready or already downloading.
+    `entry` is the song's yt_dlp info dict, if it's already been resolved.
+    """
+    guild_tasks = _prefetch_tasks.setdefault(guild_id, {})
+    if is_song_ready(song) or id(song) in guild_tasks:
+        return
+    guild_tasks[id(song)] = asyncio.create_task(prefetch_song(guild_id, song, entry))
+
+async def prefetch_song(guild_id, song, entry=None):
+    """
+    Background task for prefetch_queue.  If the song can't be downloaded it's dropped from the
+    queue and the guild's text channel is told about it.
+    """
+    try:
+        error = await prepare_song(guild_id, song, entry)
+        if error:
+            queue = _guild_queues.get(guild_id, [])
+            for i, queued_song in enumerate(queue):
+                if queued_song is song:
+                    del queue[i]
+                    mark_guild_dirty(guild_id)
+                    logger.info("Removed %s from the queue: %s", song['title'], error)
+                    channel = _guild_channels.get(guild_id)
+                    if channel is not None:
+                        await channel.send(f"Couldn't get {song['title']}, removed it from the queue. {error}")
+                    break
         else:
-            print(f"Queue is empty for guild {guild_name}. Resetting idle timer to default timeout.")
-            await start_idle_timer(voice_client, timeout=settings.idle_timeout)
+            logger.debug("Prefetched: %s", song['title'])
+            mark_guild_dirty(guild_id)
+        prepare_next_source(guild_id)
+        return error
+    finally:
+        guild_tasks = _prefetch_tasks.get(guild_id, {})
+        if guild_tasks.get(id(song)) is asyncio.current_task():
+            del guild_tasks[id(song)]
+
+async def ready_song(voice_client, message_channel, song):
+    """
+    Makes sure a song that's about to play is downloaded.  If it can't be, tells the text channel and
+    moves on to the next song in the queue.  Returns the song that's ready to play, or None (after
+    starting the idle countdown) if the queue ran out.
+    """
+    guild_id = voice_client.guild.id
+    while True:
+        error = await ensure_song_ready(guild_id, song)
+        if error is None:
+            return song
+        await message_channel.send(f"Couldn't play {song['title']}: {error}")
+        if not _guild_queues.get(guild_id):
+            _now_playing.pop(guild_id, None)
+            mark_guild_dirty(guild_id)
+            update_idle_state(voice_client, playing=False)
+            return None
+        song = _guild_queues[guild_id].pop(0)
+
+async def start_song(voice_client, message_channel, song, start_at=0, ended_at=None):
+    """
+    Plays a song that's already been taken off the queue, without holding the guild's lock while it
+    downloads: the song is made ready first (see ready_song), and the lock is only taken to start it.
+    If something else started playing in the meantime, the song goes back to the front of the queue.
+    Returns True if the song started.
+    """
+    guild_id = voice_client.guild.id
+    ready = await ready_song(voice_client, message_channel, song)
+    if ready is None:
+        return False
+    if ready is not song:
+        start_at = 0
+
+    async with await get_guild_lock(guild_id):
+        if not voice_client.is_connected():
+            return False
+        if voice_client.is_playing() or voice_client.is_paused():
+            _guild_queues.setdefault(guild_id, []).insert(0, ready)
+            mark_guild_dirty(guild_id)
+            prefetch_queue(guild_id)
+            prepare_next_source(guild_id)
+            return False
+        await play_song(voice_client, message_channel, ready, start_at=start_at, ended_at=ended_at)
+    return True
+
+async def play_song(voice_client, message_channel, song, start_at=0, requested_at=None, ended_at=None, stream=None):
+    """
+    Plays a song, starting `start_at` seconds in, and handles the queue.
+    If the song can't be downloaded, moves on to the next song in the queue.
+    `stream` (from prepare_stream) plays the song straight from YouTube if it isn't downloaded yet.
+    `requested_at` (when the play command came in) and `ended_at` (when the previous song's audio
+    stopped) are time.perf_counter() values used for the time-to-first-audio and transition gap metrics.
+    """
+    guild_id = voice_client.guild.id
 
-async def handle_play_command(voice_client, query, message_channel):
+    # Make sure the song is downloaded (normally the prefetcher has already done this)
+    if stream is None or is_song_ready(song):
+        stream = None
+        ready = await ready_song(voice_client, message_channel, song)
+        if ready is None:
+            return
+        if ready is not song:
+            song, start_at = ready, 0
+
+    def first_frame(source):
+        now = time.perf_counter()
+        observe_stage("ffmpeg_start", now - source.created)
+        if requested_at is not None:
+            observe_stage("time_to_first_audio", now - requested_at)
+        if ended_at is not None:
+            observe_stage("transition_gap", now - ended_at)
+            increment_counter("restarted_transitions")
+
+    audio_source = create_audio_source(guild_id, song, start_at, on_first_frame=first_frame, stream=stream)
+    _now_playing[guild_id] = {"song": song, "source": audio_source}
+
+    get_guild_player(voice_client).play(song, audio_source, message_channel)
+    update_idle_state(voice_client, playing=True)
+
+    # Get the next few songs downloading while this one plays, and line up the next one
+    prefetch_queue(guild_id)
+    prepare_next_source(guild_id)
+
+    # Let the text channel know once audio is already on its way
+    await message_channel.send(f"Now playing: {song['title']}")
+
+def create_audio_source(guild_id, song, start_at=0, on_first_frame=None, stream=None):
+    """
+    Starts ffmpeg on a downloaded song (or on `stream`, see prepare_stream), `start_at` seconds in,
+    and returns the audio source for it.
+    """
+    # Seek into the file if we're resuming part way through
+    before_options = f"-ss {start_at:.2f}" if start_at > 0 else ""
+    source = song.get("filepath")
+    if stream is not None:
+        # Ride out dropped connections instead of ending the song early
+        source = stream["url"]
+        if source.startswith(("http://", "https://")):
+            before_options += " -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+        if stream["headers"]:
+            headers = "".join(f"{name}: {value}\r\n" for name, value in stream["headers"].items())
+            before_options += f" -headers {shlex.quote(headers)}"
+    before_options = before_options.strip() or None
+
+    # Play the audio from the cached file.  Files rendered at the current volume and loudness
+    # settings are Opus already, so ffmpeg just demuxes the packets; anything else (streams included)
+    # gets its volume adjusted and is encoded to Opus by ffmpeg rather than by discord.py.
+    # Crossfading needs raw PCM to mix, so then everything is decoded and discord.py does the encoding.
+    playback_gain = playback_gain_for(song.get("gain_db", 0.0)) / song.get("gain", 1.0)
+    if stream is not None:
+        playback_gain = playback_gain_for(0.0)
+    if settings.crossfade_seconds > 0:
+        audio_source = discord.FFmpegPCMAudio(
+            source,
+            before_options=before_options,
+            options=f'-vn -filter:a "volume={playback_gain:g}"'
+        )
+    elif stream is None and song.get("codec") == "opus" and abs(playback_gain - 1.0) < 0.001:
+        audio_source = discord.FFmpegOpusAudio(source, codec="copy", before_options=before_options)
+    else:
+        audio_source = discord.FFmpegOpusAudio(
+            source,
+            bitrate=settings.opus_bitrate,
+            before_options=before_options,
+            options=f'-filter:a "volume={playback_gain:g}"'
+        )
+
+    audio_source = PositionTrackingSource(audio_source, offset=start_at, on_first_frame=on_first_frame)
+    track_ffmpeg_process(audio_source._process, guild_id, "playback", audio_source)
+    return audio_source
+
+def prepare_next_source(guild_id):
+    """
+    Lines up the song at the front of the queue on the guild's stream (if it's downloaded), so playback
+    can switch to it without a gap.  Call whenever the song playing or the front of the queue changes.
+    """
+    player = _guild_players.get(guild_id)
+    if player is None or player.stream is None or player.stream.finished:
+        return
+    queue = _guild_queues.get(guild_id) or []
+    song = queue[0] if queue and is_song_ready(queue[0]) else None
+    if song is player.stream.next_song:
+        return
+    try:
+        source = create_audio_source(guild_id, song) if song is not None else None
+    except Exception as e:
+        logger.error("Failed to line up %s: %s", song['title'], e)
+        source = None
+    player.stream.set_next(song if source is not None else None, source)
+
+async def handle_song_transition(voice_client, message_channel, song, source):
+    """
+    Catches up with a stream that has already moved on to the next song: takes the song off the queue,
+    makes it the one playing, and lines up the one after it.
+    """
+    guild_id = voice_client.guild.id
+
+    # The previous song's ffmpeg process is done with
+    reap_ffmpeg_processes(guild_id)
+
+    async with await get_guild_lock(guild_id):
+        queue = _guild_queues.get(guild_id, [])
+        for i, queued_song in enumerate(queue):
+            if queued_song is song:
+                del queue[i]
+                break
+        _now_playing[guild_id] = {"song": song, "source": source}
+        mark_guild_dirty(guild_id)
+        prefetch_queue(guild_id)
+        prepare_next_source(guild_id)
+
+    await message_channel.send(f"Now playing: {song['title']}")
+
+async def handle_song_end(voice_client, message_channel, ended_at=None):
     """
-    Plays the audio from the given query or URL in the voice channel.
-    If a song is already playing or the queue exists, adds the song to the queue.
+    Handles the end of a song and plays the next song in the queue if available.
+    Starts the idle countdown if the queue is empty.
     """
     guild_id = voice_client.guild.id
+    guild_name = voice_client.guild.name
+
+    # The song's ffmpeg process is done with
+    reap_ffmpeg_processes(guild_id)
 
+    # Playback ended because we left voice; keep the queue for when we come back
+    if not voice_client.is_connected():
+        return
+
+    async with await get_guild_lock(guild_id):
+        if not _guild_queues.get(guild_id):
+            logger.info("Queue is empty for guild %s. Starting idle countdown.", guild_name)
+            _now_playing.pop(guild_id, None)
+            mark_guild_dirty(guild_id)
+            update_idle_state(voice_client, playing=False)
+            return
+        next_song = _guild_queues[guild_id].pop(0)
+        mark_guild_dirty(guild_id)
+
+    # Play the next song in the queue
+    try:
+        await start_song(voice_client, message_channel, next_song, ended_at=ended_at)
+    except Exception as e:
+        logger.error("Error playing next song: %s", e)
+
+async def wait_until_connected(voice_client):
+    """
+    Waits (up to `settings.voice_ready_timeout` seconds) for a new voice connection to be ready to play,
+    rather than for a fixed time, so the first song in a channel starts as soon as it can.
+    Returns whether it's connected.
+    """
+    deadline = time.monotonic() + settings.voice_ready_timeout
+    while not voice_client.is_connected():
+        if time.monotonic() >= deadline:
+            logger.warning("Voice connection in guild %s still isn't ready.", voice_client.guild.id)
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+async def get_guild_lock(guild_id):
+    """
+    Returns the guild's lock, creating it if needed.  The global lock only guards this registry;
+    everything else a guild does happens under its own lock, so guilds never wait on each other.
+    """
     async with _global_lock:
         if guild_id not in _guild_locks:
             _guild_locks[guild_id] = asyncio.Lock()
-        async with _guild_locks[guild_id]:
-            # Check if the query is a YouTube URL
-            youtube_url_pattern = r"(https?://)?(www\.)?(youtube\.com|youtu\.be)/.+"
-            is_url = re.match(youtube_url_pattern, query)
-
-            if is_url:
-                url = query.split("&")[0]
-                print(f"Detected YouTube URL: {url}")
-                title = get_title_from_url(url)
-            else:
-                # Perform a YouTube search if it's not a URL
-                info = search_youtube(query)
-                if info is None:
-                    print("No information returned from YouTube search.")
-                    await message_channel.send("No results found for your query.")
-                    return
+        return _guild_locks[guild_id]
 
-                # Navigate to the correct entry and formats
-                if 'entries' not in info or not info['entries']:
-                    print("Error: 'entries' key not found or empty in the info dictionary.")
-                    await message_channel.send("No results found for your query.")
-                    return
+async def handle_play_command(voice_client, query, message_channel, requested_at=None):
+    """
+    Plays the audio from the given query or URL in the voice channel, or queues it up if something
+    is already playing.  A playlist URL queues the whole playlist, and several queries separated by
+    `settings.bulk_separator` are queued in order.
+    `requested_at` is the time.perf_counter() the command arrived, for the time-to-first-audio metric.
+    """
+    guild_id = voice_client.guild.id
+    _guild_channels[guild_id] = message_channel
 
-                formats = info['entries'][0].get('formats', [])
-                if not formats:
-                    print("Error: 'formats' key not found or empty in the first entry.")
-                    await message_channel.send("No playable formats found for your query.")
-                    return
+    if is_playlist_url(query):
+        await handle_playlist_command(voice_client, query, message_channel, requested_at)
+        return
 
-                # Find the format with format_id == 234
-                url = None
-                for fmt in formats:
-                    if fmt.get('format_id') == '234':
-                        url = fmt.get('url')
-                        break
-                title = info['entries'][0].get('title', "Unknown Title")
-                print(f"Title: {title}")
-
-                if not url:
-                    print("Error: No format with format_id == 234 found.")
-                    await message_channel.send("No playable formats found for your query.")
-                    return
+    queries = [part.strip() for part in query.split(settings.bulk_separator) if part.strip()]
+    if len(queries) > 1:
+        await enqueue_songs(voice_client, [new_song(part) for part in queries], message_channel, requested_at)
+        return
 
-            # Download the audio file to the cache directory
-            filepath = await download_audio(url, cache_dir, title)
-            if not filepath:
-                await message_channel.send("Failed to download audio.")
-                return
+    await play_or_enqueue(voice_client, new_song(query), message_channel, requested_at)
 
-            # Extract duration
-            duration = info['entries'][0].get('duration', 600)
-            if (duration == 600) and is_url:
-                duration = get_audio_duration(filepath)
-
-            # Initialize the queue for the guild if it doesn't exist
-            if guild_id not in _guild_queues:
-                _guild_queues[guild_id] = []
-
-            # Create the song dict
-            song = {
-                "title": title,
-                "url": url,
-                "filepath": filepath,
-                "duration": duration
-            }
-
-            # If the bot is not currently playing anything, start playback immediately
-            if not voice_client.is_playing() and len(_guild_queues[guild_id]) == 0:
-                await play_song(voice_client, message_channel, song)
-            else:
-                # Add the song to the queue
-                _guild_queues[guild_id].append(song)
-                print(f"Added to queue: {title}")
-                await message_channel.send(f"Added to queue: {title}")
+async def play_or_enqueue(voice_client, song, message_channel, requested_at=None):
+    """
+    Starts playing a song if nothing is playing, otherwise adds it to the queue.
+    If a song is already playing or the queue exists, adds the song to the queue right away;
+    it's resolved and downloaded in the background by the prefetcher.
+    Otherwise the song is resolved and downloaded first, without holding any locks, and only
+    the final enqueue/start happens under the guild's lock.
+    Returns True if the song was played or queued.
+    """
+    guild_id = voice_client.guild.id
+    guild_lock = await get_guild_lock(guild_id)
+
+    # Initialize the queue for the guild if it doesn't exist
+    if guild_id not in _guild_queues:
+        _guild_queues[guild_id] = []
+
+    if len(_guild_queues[guild_id]) >= queue_limit:
+        await message_channel.send(f"The queue is full ({queue_limit} songs).")
+        return False
+
+    # Nothing playing: get the song ready now (outside the lock) so we can start right away.
+    # With `settings.stream_first` that means a stream URL to play from while the download runs.
+    stream = None
+    if not voice_client.is_playing() and len(_guild_queues[guild_id]) == 0:
+        if settings.stream_first and not is_song_ready(song):
+            stream, error = await prepare_stream(guild_id, song)
+        else:
+            error = await ensure_song_ready(guild_id, song)
+        if error:
+            await message_channel.send(f"Couldn't play {song['title']}: {error}")
+            return False
+
+    async with guild_lock:
+        # If the bot is (still) not playing anything, start playback immediately
+        if not voice_client.is_playing() and len(_guild_queues[guild_id]) == 0:
+            await play_song(voice_client, message_channel, song, requested_at=requested_at, stream=stream)
+        else:
+            # Add the song to the queue and start fetching it
+            _guild_queues[guild_id].append(song)
+            prefetch_queue(guild_id)
+            logger.debug("Added to queue: %s", song['title'])
+            await message_channel.send(f"Added to queue: {song['title']}")
 
-            # Save the bot state
-            save_bot_state()
+        # Save the bot state
+        mark_guild_dirty(guild_id)
+    return True
+
+async def enqueue_songs(voice_client, songs, message_channel, requested_at=None):
+    """
+    Queues several songs in order.  The first one that works is played (or queued) the usual way,
+    so playback starts as soon as it's downloaded; the rest go straight onto the queue, where the
+    prefetcher downloads them a few at a time.
+    """
+    songs = list(songs)
+    while songs:
+        if await play_or_enqueue(voice_client, songs.pop(0), message_channel, requested_at):
+            break
+    if not songs:
+        return
+
+    added = await append_songs(voice_client, message_channel, songs)
+    if added:
+        await message_channel.send(f"Added {added} more songs to the queue.")
+    if added < len(songs):
+        await message_channel.send(f"The queue is full ({queue_limit} songs); skipped {len(songs) - added}.")
+
+async def append_songs(voice_client, message_channel, songs):
+    """
+    Adds songs to the end of the guild's queue, as many as fit, and starts playing if playback has
+    already run out.  Returns how many were added.
+    """
+    guild_id = voice_client.guild.id
+    next_song = None
+    async with await get_guild_lock(guild_id):
+        queue = _guild_queues.setdefault(guild_id, [])
+        songs = songs[:max(0, queue_limit - len(queue))]
+        if not songs:
+            return 0
+        queue.extend(songs)
+        mark_guild_dirty(guild_id)
+        if not voice_client.is_playing() and not voice_client.is_paused():
+            next_song = queue.pop(0)
+        else:
+            prefetch_queue(guild_id)
+            prepare_next_source(guild_id)
+    if next_song is not None:
+        await start_song(voice_client, message_channel, next_song)
+    return len(songs)
+
+def is_playlist_url(query):
+    """
+    True for a YouTube playlist link (not a video link that happens to be playing from a playlist).
+    """
+    return re.match(r"(https?://)?(www\.|m\.|music\.)?youtube\.com/playlist\?(.*&)?list=", query.strip()) is not None
+
+async def handle_playlist_command(voice_client, url, message_channel, requested_at=None):
+    """
+    Queues up a YouTube playlist.  The playlist is read page by page without looking up each video,
+    and entries are queued as the pages come in.  Playback starts as soon as the first entry is
+    downloaded; the rest are resolved and downloaded ahead of time by the prefetcher like any queued song.
+    """
+    guild_id = voice_client.guild.id
+    room = queue_limit - len(_guild_queues.get(guild_id, []))
+    if room <= 0:
+        await message_channel.send(f"The queue is full ({queue_limit} songs).")
+        return
+
+    # The extractor runs on the fetch worker pool and hands us entries in batches as it goes
+    loop = asyncio.get_running_loop()
+    batches = asyncio.Queue()
+    extraction = asyncio.create_task(run_in_fetch_pool(
+        guild_id, extract_playlist_blocking, url, room,
+        lambda entries: loop.call_soon_threadsafe(batches.put_nowait, entries)
+    ))
+    extraction.add_done_callback(lambda _: batches.put_nowait(None))
+
+    started = False
+    added = 0
+    while True:
+        batch = await batches.get()
+        if batch is None:
+            break
+        songs = [playlist_song(entry) for entry in batch]
+        while songs and not started:
+            started = await play_or_enqueue(voice_client, songs.pop(0), message_channel, requested_at)
+            added += started
+        if songs:
+            added += await append_songs(voice_client, message_channel, songs)
+
+    try:
+        await extraction
+    except (asyncio.CancelledError, asyncio.TimeoutError):
+        logger.warning("Playlist extraction didn't finish: %s", url)
+    if added:
+        await message_channel.send(f"Queued {added} songs from the playlist.")
+    else:
+        await message_channel.send("Couldn't get any songs from that playlist.")
+
+def playlist_song(entry):
+    """
+    Creates a queue entry for a (flat) playlist entry, which has a video ID and title but hasn't been resolved.
+    """
+    song = new_song(f"https://www.youtube.com/watch?v={entry['id']}")
+    if entry.get("title"):
+        song["title"] = entry["title"]
+    return song
+
+def extract_playlist_blocking(url, limit, on_entries, cancel_event=None):
+    """
+    Lists up to `limit` videos of a playlist with yt_dlp, without extracting each video, calling
+    `on_entries(list of entry dicts)` as they come in: the first entry on its own so playback can
+    start right away, then in batches of `settings.playlist_batch_size`.  yt_dlp's processing step is
+    skipped (it would read the whole listing before returning anything), and the extractor's entries
+    are consumed as its pages are fetched, so long playlists start queueing before they've been read
+    to the end and a cancel stops the listing part way through.
+    Blocking; call it through run_in_fetch_pool.  Returns how many entries were found.
+    """
+    ydl_opts = {
+        'quiet': True,
+        'extract_flat': 'in_playlist',
+        'lazy_playlist': True,
+        'playlistend': limit,
+    }
+    count = 0
+    batch = []
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        try:
+            info = ydl.extract_info(url, download=False, process=False)
+            # A watch?v=...&list=... URL comes back as a pointer to the playlist itself
+            for _ in range(3):
+                if info.get("_type") not in ("url", "url_transparent"):
+                    break
+                info = ydl.extract_info(info["url"], download=False, process=False)
+            for entry in info.get("entries") or []:
+                if cancel_event and cancel_event.is_set():
+                    break
+                if not entry or not entry.get("id"):
+                    continue
+                batch.append(entry)
+                count += 1
+                if count == 1 or len(batch) >= settings.playlist_batch_size:
+                    on_entries(batch)
+                    batch = []
+                if count >= limit:
+                    break
+        except Exception as e:
+            logger.error("Error extracting playlist %s: %s", url, e)
+    if batch:
+        on_entries(batch)
+    return count
 
 def parse_message(message):
     """
@@ -622,7 +3028,7 @@ def parse_message(message):
 
 @bot.event
 async def on_message(message):
-    print(f"Received message: {message.content}")
+    logger.debug("Received message: %s", message.content)
     # Ignore messages from the bot itself
     if message.author == bot.user:
         return
@@ -635,18 +3041,19 @@ async def on_message(message):
     if command == settings.wake_phrase:
         # PLAY
         if verb == "play" and args:
+            requested_at = time.perf_counter()
             voice_channel = message.author.voice.channel if message.author.voice else None
             if voice_channel is None:
                 await channel.send("You need to be in a voice channel to use this command.")
                 return
 
             guild_id = message.guild.id
-            print(f"DEBUG: Play command for guild {guild_id}")
-            print(f"DEBUG: Voice channel: {voice_channel.name} (ID: {voice_channel.id})")
-            print(f"DEBUG: Current voice clients: {[vc.guild.id for vc in bot.voice_clients]}")
-            print(f"DEBUG: Bot permissions in voice channel: {voice_channel.permissions_for(message.guild.me)}")
-            print(f"DEBUG: Bot user ID: {bot.user.id}")
-            print(f"DEBUG: Guild member count: {message.guild.member_count}")
+            logger.debug("Play command for guild %s", guild_id)
+            logger.debug("Voice channel: %s (ID: %s)", voice_channel.name, voice_channel.id)
+            logger.debug("Current voice clients: %s", [vc.guild.id for vc in bot.voice_clients])
+            logger.debug("Bot permissions in voice channel: %s", voice_channel.permissions_for(message.guild.me))
+            logger.debug("Bot user ID: %s", bot.user.id)
+            logger.debug("Guild member count: %s", message.guild.member_count)
             
             # Check bot permissions
             permissions = voice_channel.permissions_for(message.guild.me)
@@ -660,15 +3067,15 @@ async def on_message(message):
             # Check if the bot is already connected to a voice channel in the same guild
             existing_voice_client = discord.utils.get(bot.voice_clients, guild=message.guild)
             if existing_voice_client and existing_voice_client.is_connected():
-                print(f"DEBUG: Bot is already connected to voice in guild {guild_id}")
-                await handle_play_command(existing_voice_client, args, message.channel)
+                logger.debug("Bot is already connected to voice in guild %s", guild_id)
+                await handle_play_command(existing_voice_client, args, message.channel, requested_at)
             else:
-                print(f"DEBUG: Attempting to connect to voice channel...")
+                logger.debug("Attempting to connect to voice channel...")
                 
                 # Clean up any stale voice clients
                 stale_voice_client = discord.utils.get(bot.voice_clients, guild=voice_channel.guild)
                 if stale_voice_client:
-                    print(f"DEBUG: Found stale voice client, cleaning up...")
+                    logger.debug("Found stale voice client, cleaning up...")
                     await stale_voice_client.disconnect(force=True)
                     await asyncio.sleep(3)  # Longer wait for cleanup
                 
@@ -676,10 +3083,10 @@ async def on_message(message):
                 _connection_failures[guild_id] = 0
                 
                 try:
-                    print(f"DEBUG: About to call voice_channel.connect()...")
-                    print(f"DEBUG: Voice channel region: {getattr(voice_channel.guild, 'region', 'Unknown')}")
-                    print(f"DEBUG: Voice channel bitrate: {voice_channel.bitrate}")
-                    print(f"DEBUG: Voice channel user_limit: {voice_channel.user_limit}")
+                    logger.debug("About to call voice_channel.connect()...")
+                    logger.debug("Voice channel region: %s", getattr(voice_channel.guild, 'region', 'Unknown'))
+                    logger.debug("Voice channel bitrate: %s", voice_channel.bitrate)
+                    logger.debug("Voice channel user_limit: %s", voice_channel.user_limit)
                     
                     # Try connecting with a timeout
                     voice_client = await asyncio.wait_for(
@@ -687,17 +3094,17 @@ async def on_message(message):
                         timeout=35.0
                     )
                     
-                    print(f"DEBUG: Successfully connected to voice channel")
-                    print(f"DEBUG: Voice client connected: {voice_client.is_connected()}")
-                    print(f"DEBUG: Voice client latency: {voice_client.latency}")
+                    logger.debug("Successfully connected to voice channel")
+                    logger.debug("Voice client connected: %s", voice_client.is_connected())
+                    logger.debug("Voice client latency: %s", voice_client.latency)
                     
-                    await asyncio.sleep(2)  # Wait for connection to stabilize
-                    await handle_play_command(voice_client, args, message.channel)
+                    await wait_until_connected(voice_client)
+                    await handle_play_command(voice_client, args, message.channel, requested_at)
                     
                 except discord.errors.ConnectionClosed as e:
-                    print(f"DEBUG: Connection closed during connect: {e}")
-                    print(f"DEBUG: Close code: {e.code}")
-                    print(f"DEBUG: Close reason lookup:")
+                    logger.warning("Connection closed during connect: %s", e)
+                    logger.debug("Close code: %s", e.code)
+                    logger.debug("Close reason lookup:")
                     close_codes = {
                         4001: "Unknown opcode",
                         4002: "Failed to decode payload",
@@ -713,17 +3120,17 @@ async def on_message(message):
                         4016: "Unknown encryption mode"
                     }
                     reason = close_codes.get(e.code, "Unknown error code")
-                    print(f"DEBUG: Error {e.code}: {reason}")
+                    logger.debug("Error %s: %s", e.code, reason)
                     await channel.send(f"Voice connection failed: {reason} (Code {e.code})")
                     
                 except asyncio.TimeoutError:
-                    print(f"DEBUG: Connection attempt timed out")
+                    logger.warning("Connection attempt timed out")
                     await channel.send("Voice connection timed out")
                     
                 except Exception as e:
-                    print(f"DEBUG: Unexpected error during voice connect: {e}")
-                    print(f"DEBUG: Exception type: {type(e).__name__}")
-                    print(f"DEBUG: Exception args: {e.args}")
+                    logger.warning("Unexpected error during voice connect: %s", e)
+                    logger.debug("Exception type: %s", type(e).__name__)
+                    logger.debug("Exception args: %s", e.args)
                     await channel.send(f"Failed to connect to voice channel: {e}")
 
         # STOP
@@ -756,12 +3163,15 @@ async def on_message(message):
                 "```"
                 f"Current valid commands for {bot_name}:\n"
                 f"!{settings.wake_phrase} play <YouTube URL or search term> - Play audio from YouTube.\n"
+                f"!{settings.wake_phrase} play <playlist URL> - Queue up a whole YouTube playlist.\n"
+                f"!{settings.wake_phrase} play <search>{settings.bulk_separator} <search>{settings.bulk_separator} ... - Queue up several songs at once.\n"
                 f"!{settings.wake_phrase} stop - Stop audio playback and disconnect.\n"
                 f"!{settings.wake_phrase} pause - Pause audio playback.\n"
                 f"!{settings.wake_phrase} resume - Resume audio playback.\n"
                 f"!{settings.wake_phrase} skip - Skip the current song.\n"
                 f"!{settings.wake_phrase} queue - Show the current queue.\n"
                 f"!{settings.wake_phrase} remove <song number> - Remove a song from the queue.\n"
+                f"!{settings.wake_phrase} metrics - Show how long each step of playing a song is taking.\n"
                 f"!{settings.wake_phrase} help - Show this help message."
                 "```"
             )
@@ -787,7 +3197,7 @@ async def on_message(message):
                 guild_id = voice_client.guild.id
                 if guild_id in _guild_queues and _guild_queues[guild_id]:
                     # Stop the current playback
-                    stop_playback(voice_client)
+                    get_guild_player(voice_client).skip()
             else:
                 await channel.send(f"{bot_name} is not connected to a voice channel.")
 
@@ -802,6 +3212,8 @@ async def on_message(message):
                         queue = _guild_queues.get(voice_client.guild.id, [])
                         if 0 <= index < len(queue):
                             removed_song = queue.pop(index)
+                            mark_guild_dirty(voice_client.guild.id)
+                            prepare_next_source(voice_client.guild.id)
                             await channel.send(f"Removed {removed_song['title']} from the queue.")
                         else:
                             await channel.send("Invalid song number.")
@@ -812,12 +3224,23 @@ async def on_message(message):
             else:
                 await channel.send("Please provide a valid song number to remove.")
 
+        # METRICS
+        elif verb == "metrics":
+            await channel.send(format_metrics_summary())
+
         # DEBUG
         elif verb == "debug":
             debug_info = (
                 f"**Bot Debug Info:**\n"
                 f"Connected to {len(bot.guilds)} guilds\n"
                 f"Voice clients: {len(bot.voice_clients)}\n"
+                f"Cache janitor: {_janitor_stats['passes']} passes, {_janitor_stats['files_evicted']} files evicted, "
+                f"{_janitor_stats['bytes_reclaimed']} bytes reclaimed\n"
+                f"Search cache: {_search_cache_stats['hits']} hits, {_search_cache_stats['misses']} misses\n"
+                f"Startup: ready after {_startup_metrics['ready']:.1f}s, music after {_startup_metrics['time_to_music']}s, "
+                f"{_startup_metrics['guilds_restored']} sessions restored\n"
+                f"Event loop stalls: {_counters.get('event_loop_stalls', 0)}\n"
+                f"{format_loop_stalls() or 'No stalls recorded.'}\n"
                 f"Latency: {bot.latency * 1000:.1f}ms\n"
                 f"Python version: {sys.version}\n"
                 f"Discord.py version: {discord.__version__}\n"
@@ -834,10 +3257,10 @@ def handle_exit_signal(signal_received, _):
     """
     Handles exit signals (e.g., SIGINT, SIGTERM) and performs cleanup before exiting.
     """
-    print(f"Signal {signal_received} received. Cleaning up before exiting...")
+    logger.info("Signal %s received. Cleaning up before exiting...", signal_received)
 
     # Save the bot state
-    save_bot_state()
+    save_bot_state_now()
 
     # Terminate lingering ffmpeg processes
     terminate_ffmpeg_processes()
@@ -847,11 +3270,84 @@ def handle_exit_signal(signal_received, _):
         loop = asyncio.get_event_loop()
         loop.create_task(bot.close())  # Schedule bot.close() on the existing event loop
 
-    print("Cleanup complete. Exiting.")
+    logger.info("Cleanup complete. Exiting.")
     sys.exit(0)
 
-signal.signal(signal.SIGINT, handle_exit_signal)
-signal.signal(signal.SIGTERM, handle_exit_signal)
-
-ensure_cache_dir_exists()
-bot.run(api_key)
\ No newline at end of file
+def run_workers():
+    """
+    Runs a sharded deployment: starts `settings.worker_processes` copies of the bot, each connecting
+    its own slice of the `settings.shard_count` shards (so each owns the queues, players and idle timers
+    of the guilds on those shards), and restarts any that exit.  A worker that keeps dying soon after
+    it starts (e.g. a bad API key) is restarted with exponential backoff, up to
+    `settings.worker_restart_max_delay` seconds apart.  Shutdown signals are passed on.
+    Workers share the audio cache and the state store; everything else is per process.
+    """
+    worker_count = min(settings.worker_processes, settings.shard_count)
+    shard_slices = [list(range(settings.shard_count))[i::worker_count] for i in range(worker_count)]
+    workers = {}
+    started = {}  # index -> time.monotonic() the worker was last started
+    failures = {}  # index -> restarts in a row after the worker died young
+    restart_at = {}  # index -> time.monotonic() a dead worker is due to be restarted
+    last_start = 0
+    stopping = False
+
+    def start_worker(index):
+        nonlocal last_start
+        env = dict(os.environ, PANCRYTHM_WORKER=str(index), PANCRYTHM_SHARD_IDS=",".join(map(str, shard_slices[index])))
+        workers[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        started[index] = last_start = time.monotonic()
+        logger.info("Started worker %s (PID %s) for shards %s", index, workers[index].pid, shard_slices[index])
+
+    def stop_workers(signal_received, _):
+        nonlocal stopping
+        logger.info("Signal %s received. Stopping workers...", signal_received)
+        stopping = True
+        for process in workers.values():
+            process.send_signal(signal_received)
+
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+
+    for index in range(worker_count):
+        if index:
+            time.sleep(settings.worker_start_delay)  # discord limits how fast new connections can identify
+        start_worker(index)
+
+    while workers:
+        time.sleep(1)
+        now = time.monotonic()
+        for index, process in list(workers.items()):
+            if process.poll() is None:
+                continue
+            if stopping:
+                del workers[index]
+                restart_at.pop(index, None)
+                continue
+            if index not in restart_at:
+                # Only count it as a failure if the worker didn't stay up for a while
+                if now - started[index] < settings.worker_restart_max_delay:
+                    failures[index] = failures.get(index, 0) + 1
+                else:
+                    failures[index] = 0
+                delay = min(settings.worker_start_delay * 2 ** failures[index], settings.worker_restart_max_delay)
+                restart_at[index] = now + delay
+                logger.warning(
+                    "Worker %s exited with code %s; restarting it in %ss.", index, process.returncode, delay
+                )
+            # Keep restarts spaced out like the initial startup, for discord's connection rate limit
+            if now >= restart_at[index] and now - last_start >= settings.worker_start_delay:
+                del restart_at[index]
+                start_worker(index)
+
+if __name__ == "__main__":
+    if settings.shard_count and settings.worker_processes > 1 and _shard_ids is None:
+        run_workers()
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, handle_exit_signal)
+    signal.signal(signal.SIGTERM, handle_exit_signal)
+
+    ensure_cache_dir_exists()
+    open_cache_index()
+    _state_executor.submit(open_state_store_blocking).result()
+    bot.run(settings.load_discord_api_key())
\ No newline at end of file
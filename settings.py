@@ -14,7 +14,54 @@ def load_discord_api_key():
 bot_name = "Pancrythm" # flavor text, used in bot responses
 wake_phrase = "cake" # i.e. !cake <command> to interact with the bot
 idle_timeout = 300  # in seconds, default is 5 minutes (300 seconds)
+alone_timeout = 60  # in seconds, how long to wait for someone to come back after everyone leaves the voice channel
 volume = 0.5  # Set the volume (1.0 is 100%, 0.5 is 50%, etc.)
 cache_dir = "cache"  # Directory to store cached files 
 queue_limit = 100 # limit the number of songs in the queue
-status = "help"  # Status message for the bot
\ No newline at end of file
+status = "help"  # Status message for the bot
+fetch_workers = 4  # number of worker threads for YouTube searches/downloads (shared by all servers)
+fetch_per_guild = 2  # max searches/downloads running at once for a single server
+fetch_timeout = 900  # in seconds, give up on a single search/download after this long
+cache_max_bytes = 5 * 1024 ** 3  # in bytes, least recently played songs are evicted past this (default 5 GiB)
+cache_index_path = "cache_index.db"  # SQLite index of cached files (video ID, format, size, last played)
+cache_orphan_max_age = 7 * 24 * 3600  # in seconds, files in cache_dir that aren't in the index are removed after this
+janitor_interval = 10  # in seconds, how often the background cache janitor runs a batch
+janitor_batch_size = 200  # max files (and index entries) the cache janitor checks per batch
+prefetch_count = 3  # number of upcoming queue entries to download in the background while a song plays
+prefetch_transcode = False  # always transcode prefetched songs to Opus ahead of time, even if they're already Opus
+opus_bitrate = 96  # in kbps, bitrate for songs transcoded to Opus (at cache time, or during playback if needed)
+normalize_loudness = True  # measure each song's loudness once when it's cached and even out levels between songs
+target_loudness = -16  # in LUFS, loudness songs are normalized to (before volume is applied)
+max_loudness_boost = 12  # in dB, never boost a quiet song by more than this
+search_cache_ttl = 7 * 24 * 3600  # in seconds, how long a search term keeps resolving to the same video without asking YouTube again
+query_normalization = ["whitespace", "case"]  # search terms that only differ by these count as the same search; can also add "punctuation"
+state_db_path = "bot_state.db"  # SQLite file the queues are saved in, so they survive restarts
+state_flush_delay = 2  # in seconds, queue changes are batched up and saved this long after the first one
+state_compact_interval = 3600  # in seconds, how often the state store's write-ahead log is compacted
+restore_concurrency = 5  # max voice channels to reconnect to at once when restoring sessions after a restart
+position_save_interval = 15  # in seconds, how often the playback position is saved so restarts resume close to where they were
+ffmpeg_pidfile = "ffmpeg.pids"  # PIDs of the bot's own ffmpeg processes, so leftovers can be cleaned up after a crash
+ffmpeg_watchdog_interval = 5  # in seconds, how often ffmpeg processes are checked for being finished, orphaned or hung
+ffmpeg_hang_timeout = 15  # in seconds, an ffmpeg process that produces no audio for this long while playing is killed
+crossfade_seconds = 0  # in seconds, how long songs overlap when the queue moves on (0 is gapless); mixing means discord.py has to encode the audio, which costs more CPU
+log_level = "INFO"  # DEBUG, INFO, WARNING or ERROR; DEBUG logs every message and download step
+discord_log_level = "WARNING"  # log level for discord.py's own logging (DEBUG is very chatty)
+metrics_host = "127.0.0.1"  # address the Prometheus metrics endpoint listens on
+metrics_port = 9108  # port for the metrics endpoint (http://127.0.0.1:9108/metrics); None to turn it off
+loop_lag_interval = 0.1  # in seconds, how often the event loop's responsiveness is checked
+loop_stall_threshold = 0.25  # in seconds, the event loop being blocked longer than this is logged along with what blocked it
+shard_count = None  # number of discord shards; None runs unsharded, which is plenty for a handful of servers
+worker_processes = 1  # with shard_count set, how many processes to split the shards across (up to one per CPU core)
+worker_start_delay = 5  # in seconds, gap between starting worker processes, to stay under discord's connection rate limit
+sqlite_busy_timeout = 5  # in seconds, how long to wait for another worker process that's writing to the cache index or state store
+worker_restart_max_delay = 300  # in seconds, longest wait before restarting a worker process that keeps crashing on startup
+bulk_separator = ";"  # "!cake play song one; song two; song three" queues up all three
+playlist_batch_size = 10  # playlist entries are added to the queue this many at a time as the playlist is read
+stream_first = True  # start songs straight from YouTube while they download to the cache, instead of waiting for the download
+download_retries = 3  # extra attempts at a failed or corrupt download; each resumes where the last one stopped
+download_retry_backoff = 2  # seconds to wait before the first retry; doubles with every retry after that
+download_fragments = 4  # how many fragments of a fragmented (DASH/HLS) download to fetch at once
+duration_tolerance = 3  # seconds a download's length may differ from YouTube's before it's treated as corrupt
+cache_opus_bitrate = None  # in kbps (e.g. 64); set to store songs as Ogg Opus at this bitrate (converted as they're cached, or rendered at it when volume or loudness normalization apply), which fits about twice as many songs in cache_max_bytes; the original download is deleted
+cache_lease_seconds = 120  # in seconds, a cache file queued or playing in any worker process is protected from eviction this long (renewed while it's in use)
+voice_ready_timeout = 5  # in seconds, how long to wait for a new voice connection to be ready before trying to play anyway
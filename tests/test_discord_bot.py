@@ -0,0 +1,172 @@
+import threading
+import unittest
+from unittest import mock
+
+import yt_dlp
+
+import discord_bot
+import settings
+
+
+class DownloadRetryTest(unittest.TestCase):
+    def test_retry_delay_works_as_a_yt_dlp_sleep_function(self):
+        # yt-dlp calls retry_sleep_functions as func(n=retry number)
+        slept = []
+        with mock.patch.object(settings, "download_retry_backoff", 2), \
+                mock.patch("time.sleep", slept.append):
+            for count in (1, 2, 3):
+                yt_dlp.utils.RetryManager.report_retry(
+                    Exception("HTTP Error 503"), count, 3,
+                    sleep_func=discord_bot.download_retry_delay, info=lambda _: None, warn=lambda _: None
+                )
+        self.assertEqual(slept, [2, 4, 8])
+
+
+class FakePlaylistYoutubeDL:
+    """
+    Stands in for yt_dlp.YoutubeDL, serving a playlist whose entries come from a generator that
+    records how many have been read.
+    """
+    consumed = 0
+    calls = []
+
+    def __init__(self, opts):
+        self.opts = opts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url, download=True, process=True):
+        FakePlaylistYoutubeDL.calls.append((url, process))
+        if "watch?v=" in url:
+            return {"_type": "url", "url": "https://www.youtube.com/playlist?list=PL1"}
+
+        def entries():
+            for n in range(50):
+                FakePlaylistYoutubeDL.consumed += 1
+                yield {"_type": "url", "id": f"video{n}", "title": f"Song {n}",
+                       "url": f"https://www.youtube.com/watch?v=video{n}"}
+
+        if process:
+            return {"_type": "playlist", "entries": list(entries())}
+        return {"_type": "playlist", "entries": entries()}
+
+
+class PlaylistExtractionTest(unittest.TestCase):
+    def setUp(self):
+        FakePlaylistYoutubeDL.consumed = 0
+        FakePlaylistYoutubeDL.calls = []
+        patcher = mock.patch.object(discord_bot.yt_dlp, "YoutubeDL", FakePlaylistYoutubeDL)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_first_entry_is_handed_over_before_the_rest_are_read(self):
+        consumed_at_callback = []
+        batches = []
+
+        def on_entries(batch):
+            consumed_at_callback.append(FakePlaylistYoutubeDL.consumed)
+            batches.append([entry["id"] for entry in batch])
+
+        with mock.patch.object(settings, "playlist_batch_size", 10):
+            count = discord_bot.extract_playlist_blocking(
+                "https://www.youtube.com/playlist?list=PL1", 25, on_entries
+            )
+        self.assertEqual(count, 25)
+        self.assertEqual(consumed_at_callback[0], 1)
+        self.assertEqual(batches[0], ["video0"])
+        self.assertEqual(sum(len(batch) for batch in batches), 25)
+        self.assertEqual(FakePlaylistYoutubeDL.consumed, 25)
+        self.assertTrue(all(process is False for _, process in FakePlaylistYoutubeDL.calls))
+
+    def test_cancel_stops_reading_the_listing(self):
+        cancel_event = threading.Event()
+        discord_bot.extract_playlist_blocking(
+            "https://www.youtube.com/playlist?list=PL1", 50, lambda batch: cancel_event.set(), cancel_event
+        )
+        self.assertEqual(FakePlaylistYoutubeDL.consumed, 2)
+
+    def test_watch_url_with_list_follows_to_the_playlist(self):
+        count = discord_bot.extract_playlist_blocking(
+            "https://www.youtube.com/watch?v=video0&list=PL1", 5, lambda batch: None
+        )
+        self.assertEqual(count, 5)
+        self.assertEqual(len(FakePlaylistYoutubeDL.calls), 2)
+
+
+class SongEndLockTest(unittest.IsolatedAsyncioTestCase):
+    async def test_next_song_is_prepared_without_holding_the_guild_lock(self):
+        guild_id = 4242
+        voice_client = mock.Mock()
+        voice_client.guild.id = guild_id
+        voice_client.is_connected.return_value = True
+        voice_client.is_playing.return_value = False
+        voice_client.is_paused.return_value = False
+        song = {"title": "Next"}
+        discord_bot._guild_queues[guild_id] = [song]
+        self.addCleanup(discord_bot._guild_queues.pop, guild_id, None)
+        self.addCleanup(discord_bot._guild_locks.pop, guild_id, None)
+        lock = await discord_bot.get_guild_lock(guild_id)
+
+        lock_held_while_preparing = []
+        async def ensure_song_ready(_guild_id, _song):
+            lock_held_while_preparing.append(lock.locked())
+            return None
+        play_song = mock.AsyncMock()
+
+        with mock.patch.object(discord_bot, "ensure_song_ready", ensure_song_ready), \
+                mock.patch.object(discord_bot, "play_song", play_song), \
+                mock.patch.object(discord_bot, "reap_ffmpeg_processes"), \
+                mock.patch.object(discord_bot, "mark_guild_dirty"):
+            await discord_bot.handle_song_end(voice_client, mock.Mock())
+
+        self.assertEqual(lock_held_while_preparing, [False])
+        play_song.assert_awaited_once()
+        self.assertIs(play_song.await_args.args[2], song)
+
+
+def audio_format(format_id, acodec="opus", ext="webm", abr=128, **fields):
+    return dict(
+        format_id=format_id, acodec=acodec, ext=ext, abr=abr, vcodec="none",
+        url=f"https://example.invalid/{format_id}", **fields
+    )
+
+
+class AudioFormatTest(unittest.TestCase):
+    def choose(self, *formats):
+        entry = {"formats": list(formats)}
+        self.assertTrue(discord_bot.choose_audio_format(entry))
+        return entry["format_id"]
+
+    def test_prefers_opus_over_aac(self):
+        self.assertEqual(self.choose(audio_format("140", "mp4a.40.2", "m4a", 130), audio_format("251", abr=120)), "251")
+
+    def test_plain_track_beats_drc_track(self):
+        # yt-dlp marks dynamic-range-compressed formats with quality - 0.5 (and has_drc on newer versions)
+        self.assertEqual(self.choose(
+            audio_format("251-drc", abr=135, quality=2.5, has_drc=True),
+            audio_format("251", abr=130, quality=3),
+        ), "251")
+        self.assertEqual(self.choose(
+            audio_format("251-drc", abr=135, quality=2.5),
+            audio_format("251", abr=130, quality=3),
+        ), "251")
+
+    def test_original_audio_track_beats_higher_bitrate_dub(self):
+        self.assertEqual(self.choose(
+            audio_format("251-0", abr=150, quality=3, language="de", language_preference=-1),
+            audio_format("251-1", abr=120, quality=3, language="en", language_preference=10),
+            audio_format("140-0", "mp4a.40.2", "m4a", 160, quality=3, language="fr", language_preference=-1),
+        ), "251-1")
+
+    def test_falls_back_to_formats_with_video(self):
+        muxed = dict(audio_format("18", "mp4a.40.2", "mp4", 96), vcodec="avc1.42001E")
+        self.assertEqual(self.choose(muxed), "18")
+        self.assertFalse(discord_bot.choose_audio_format({"formats": [dict(muxed, acodec="none")]}))
+
+
+if __name__ == "__main__":
+    unittest.main()